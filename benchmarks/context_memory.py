@@ -0,0 +1,91 @@
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass
+from typing import List
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "src", "strawberry_kbqa"
+    )
+)
+
+from context import ContextData
+from generators import generate_triples
+
+
+# the list-of-dataclasses representation `ContextData` used before interning
+@dataclass
+class LegacyContext:
+    triple: List[str]
+
+
+def measure(build) -> dict:
+    gc.collect()
+    tracemalloc.start()
+
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    del result
+    gc.collect()
+
+    return {"bytes": current, "peak_bytes": peak, "seconds": elapsed}
+
+
+def run(size: int) -> dict:
+    # parse inside the measurement, like a request body, and only keep what
+    # the representation retains once the payload is dropped
+    payload = json.dumps(generate_triples(size))
+
+    def build_legacy():
+        triples = json.loads(payload)
+        return [LegacyContext(list(x.values())) for x in triples["triples"]]
+
+    def build_store():
+        return ContextData.from_triples(json.loads(payload))
+
+    context_data = ContextData.from_triples(json.loads(payload))
+    start = time.perf_counter()
+    context = str(context_data.to_compact_form())
+    compact_seconds = time.perf_counter() - start
+
+    return {
+        "size": size,
+        "legacy": measure(build_legacy),
+        "store": measure(build_store),
+        "to_compact_form_seconds": compact_seconds,
+        "compact_context_chars": len(context),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Memory used by ContextData for synthetic graphs."
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--json", action="store_true", help="Print results as JSON.")
+    args = parser.parse_args()
+
+    results = [run(size) for size in args.sizes]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            legacy, store = result["legacy"], result["store"]
+            print(
+                f"{result['size']:>9} triples: "
+                f"legacy {legacy['bytes'] / 2**20:8.1f} MiB, "
+                f"store {store['bytes'] / 2**20:8.1f} MiB "
+                f"({legacy['bytes'] / max(store['bytes'], 1):.1f}x smaller), "
+                f"to_compact_form {result['to_compact_form_seconds']:.2f}s"
+            )
@@ -0,0 +1,142 @@
+import asyncio
+import hashlib
+import threading
+import time
+from typing import Any, AsyncIterator, ClassVar, Iterator, List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+
+
+class FakeOllama(LLM):
+    # Stands in for `Ollama`: waits `latency` seconds for the first token, then
+    # produces `answer_tokens` tokens at `tokens_per_second`. The answer only
+    # depends on the prompt, and never reads as a refusal to `has_failed`.
+    model: str = "llama2"
+    base_url: str = "http://localhost:11434"
+    keep_alive: Any = None
+
+    settings: ClassVar[dict] = {
+        "latency": 0.05,
+        "tokens_per_second": 100.0,
+        "answer_tokens": 12,
+    }
+
+    calls: ClassVar[int] = 0
+    lock: ClassVar[threading.Lock] = threading.Lock()
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-ollama"
+
+    def get_tokens(self, prompt: str) -> List[str]:
+        # an empty prompt loads the model, see `ModelRegistry.preload`
+        if not prompt:
+            return []
+
+        digest = hashlib.sha1(f"{self.model}:{prompt}".encode("utf-8")).hexdigest()
+        words = ["The", "answer", "is", digest[:8]]
+        count = max(self.settings["answer_tokens"], 1)
+        return (words + ["indeed"] * count)[:count]
+
+    def get_delays(self, prompt: str) -> List[float]:
+        with FakeOllama.lock:
+            FakeOllama.calls += 1
+
+        tokens = self.get_tokens(prompt)
+        delay = 1.0 / self.settings["tokens_per_second"]
+        return [self.settings["latency"]] + [delay] * len(tokens)
+
+    def _call(self, prompt: str, stop=None, run_manager=None, **kwargs) -> str:
+        time.sleep(sum(self.get_delays(prompt)))
+        return " ".join(self.get_tokens(prompt)) + "."
+
+    async def _acall(self, prompt: str, stop=None, run_manager=None, **kwargs) -> str:
+        await asyncio.sleep(sum(self.get_delays(prompt)))
+        return " ".join(self.get_tokens(prompt)) + "."
+
+    def _stream(
+        self, prompt: str, stop=None, run_manager=None, **kwargs
+    ) -> Iterator[GenerationChunk]:
+        delays = self.get_delays(prompt)
+        time.sleep(delays[0])
+        for token, delay in zip(self.get_tokens(prompt), delays[1:]):
+            time.sleep(delay)
+            yield GenerationChunk(text=token + " ")
+
+    async def _astream(
+        self, prompt: str, stop=None, run_manager=None, **kwargs
+    ) -> AsyncIterator[GenerationChunk]:
+        delays = self.get_delays(prompt)
+        await asyncio.sleep(delays[0])
+        for token, delay in zip(self.get_tokens(prompt), delays[1:]):
+            await asyncio.sleep(delay)
+            yield GenerationChunk(text=token + " ")
+
+
+class FakeOllamaEmbeddings(Embeddings):
+    # Stands in for `OllamaEmbeddings`: `latency` seconds per call and
+    # `text_latency` per text, unit vectors seeded by the text.
+    def __init__(
+        self,
+        model: str = "llama2",
+        latency: float = 0.005,
+        text_latency: float = 0.0005,
+        dimension: int = 64,
+    ) -> None:
+        self.model = model
+        self.latency = latency
+        self.text_latency = text_latency
+        self.dimension = dimension
+
+        self.calls = 0
+        self.texts = 0
+        self.lock = threading.Lock()
+
+    def embed(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.sha1(text.encode("utf-8")).digest()[:8], "big")
+        vector = np.random.default_rng(seed).standard_normal(self.dimension)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with self.lock:
+            self.calls += 1
+            self.texts += len(texts)
+
+        time.sleep(self.latency + self.text_latency * len(texts))
+        return [self.embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    def stats(self) -> dict:
+        return {"calls": self.calls, "texts": self.texts}
+
+
+def install(
+    latency: float = 0.05,
+    tokens_per_second: float = 100.0,
+    answer_tokens: int = 12,
+    embedding_latency: float = 0.005,
+    embedding_text_latency: float = 0.0005,
+) -> FakeOllamaEmbeddings:
+    # before any pipeline is created, the model registry and the RAG pipeline
+    # then create the fakes instead of talking to Ollama
+    import models
+    import pipeline
+
+    FakeOllama.settings.update(
+        latency=latency,
+        tokens_per_second=tokens_per_second,
+        answer_tokens=answer_tokens,
+    )
+    models.Ollama = FakeOllama
+
+    embeddings = FakeOllamaEmbeddings(
+        latency=embedding_latency, text_latency=embedding_text_latency
+    )
+    pipeline.RAGPipeline.default_embeddings = embeddings
+
+    return embeddings
@@ -0,0 +1,86 @@
+import json
+import os
+import random
+from typing import List
+
+DATA_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "data", "triples.json"
+)
+
+
+def load_triples(path: str = DATA_PATH) -> List[List[str]]:
+    with open(path) as f:
+        return json.load(f)["triples"]
+
+
+def to_payload(triples: List[List[str]]) -> dict:
+    # the request body `QAHandler` takes
+    return {
+        "triples": [{"subject": s, "predicate": p, "object": o} for s, p, o in triples]
+    }
+
+
+def scale_triples(size: int, path: str = DATA_PATH) -> dict:
+    # `data/triples.json` copied until `size` facts, subjects and names get the
+    # number of their copy so that every copy is a graph of its own
+    base = load_triples(path)
+    subjects = {s for s, _, _ in base}
+    names = {o for _, p, o in base if p == "hasName"}
+
+    def rename(term: str, copy: int) -> str:
+        return f"{term}_{copy}" if term in subjects or term in names else term
+
+    triples = []
+    copy = 0
+    while len(triples) < size:
+        for s, p, o in base:
+            triples.append([rename(s, copy), p, rename(o, copy)])
+        copy += 1
+
+    return to_payload(triples[:size])
+
+
+def generate_triples(size: int, seed: int = 0) -> dict:
+    # people with a few facts each and favorite items typed into categories
+    random.seed(seed)
+
+    professions = [f"Profession{i}" for i in range(200)]
+    categories = [f"Category{i}" for i in range(50)]
+    items = [f"Item{i}" for i in range(max(1, size // 100))]
+
+    triples = []
+    for item in items:
+        triples.append([item, "rdf:type", random.choice(categories)])
+
+    person = 0
+    while len(triples) < size:
+        subject = f"person{person}"
+        triples += [
+            [subject, "hasName", f"Name{person}"],
+            [subject, "hasAge", str(random.randint(1, 99))],
+            [subject, "hasProfession", random.choice(professions)],
+            [subject, "hasFriend", f"person{random.randint(0, person)}"],
+        ]
+        for _ in range(4):
+            triples.append([subject, "hasFavorite", random.choice(items)])
+        person += 1
+
+    return to_payload(triples[:size])
+
+
+def generate_questions(triples: dict, count: int, seed: int = 0) -> List[str]:
+    # about the named people of a graph, half answered from their facts
+    random.seed(seed)
+
+    names = [x["object"] for x in triples["triples"] if x["predicate"] == "hasName"]
+    templates = [
+        "How old is {}?",
+        "What does {} do?",
+        "What is the favorite thing of {}?",
+        "Who is the friend of {}?",
+    ]
+
+    return [
+        random.choice(templates).format(random.choice(names or ["Haru"]))
+        for _ in range(count)
+    ]
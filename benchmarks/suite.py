@@ -0,0 +1,311 @@
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, List
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "src", "strawberry_kbqa"
+    )
+)
+
+import fakes
+from generators import generate_questions, generate_triples, scale_triples
+
+# fields compared against a baseline, lower is better for all of them
+COMPARED = ("mean", "p50", "p95", "p99", "seconds")
+
+
+def summarize(values: List[float]) -> dict:
+    from timer import Histogram
+
+    histogram = Histogram(max(len(values), 1))
+    for value in values:
+        histogram.observe(value)
+    return histogram.report()
+
+
+def measure(fn: Callable, repeat: int = 1) -> dict:
+    seconds = []
+    for _ in range(repeat):
+        gc.collect()
+        start_time = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start_time)
+    return summarize(seconds)
+
+
+def bench_compact(args: argparse.Namespace) -> List[dict]:
+    from context import ContextData
+
+    results = []
+    for size in args.sizes:
+        triples = generate_triples(size, args.seed)
+        context_data = ContextData.from_triples(triples)
+
+        results.append(
+            {
+                "size": size,
+                "from_triples": measure(
+                    lambda: ContextData.from_triples(triples), args.repeat
+                ),
+                "to_compact_form": measure(context_data.to_compact_form, args.repeat),
+                "compact_context_chars": len(str(context_data.to_compact_form())),
+            }
+        )
+    return results
+
+
+def bench_retrieval(args: argparse.Namespace) -> List[dict]:
+    from context import ContextData
+    from pipeline import RAGPipeline
+
+    results = []
+    for size in args.sizes:
+        if size > args.max_index_size:
+            continue
+
+        # a new pipeline per size, so the first question builds its index
+        pipeline = RAGPipeline({"graph_retrieval": False})
+        embeddings = pipeline.current_embeddings
+        calls = embeddings.stats()
+
+        triples = scale_triples(size)
+        context_data = ContextData.from_triples(triples).to_compact_form()
+        context = str(context_data)
+        question = {"input": generate_questions(triples, 1, args.seed)[0]}
+
+        # what `run` does for a question before and with the generation
+        def create() -> tuple:
+            return pipeline.create_context_chain(question, context, context_data)
+
+        cold = measure(create)
+        warm = measure(create, args.repeat)
+        run = measure(
+            lambda: pipeline.run(question, context, context_data).join(), args.repeat
+        )
+
+        results.append(
+            {
+                "size": size,
+                "cold": cold,
+                "warm": warm,
+                "run": run,
+                "embedded_texts": embeddings.stats()["texts"] - calls["texts"],
+            }
+        )
+    return results
+
+
+def create_handler(args: argparse.Namespace, **config):
+    from qa import QAHandler
+
+    # no answer cache, every question goes through the pipelines
+    return QAHandler({"answer_cache": None, "max_workers": args.max_workers, **config})
+
+
+def bench_answer(args: argparse.Namespace, **config) -> dict:
+    from timer import METRICS
+
+    handler = create_handler(args, **config)
+    triples = scale_triples(args.context_size)
+    questions = generate_questions(triples, args.requests, args.seed)
+
+    # the first answer parses and indexes the context
+    first = measure(lambda: handler.answer(questions[0], triples))
+
+    METRICS.clear()
+    seconds = []
+    for question in questions:
+        start_time = time.perf_counter()
+        handler.answer(question, triples)
+        seconds.append(time.perf_counter() - start_time)
+
+    return {
+        "context_size": args.context_size,
+        "first": first,
+        "answer": summarize(seconds),
+        "stages": METRICS.report()["stages"],
+        "races": handler.race_stats()["wins"],
+    }
+
+
+def bench_service(args: argparse.Namespace) -> List[dict]:
+    import requests
+    from server import QAService
+    from werkzeug.serving import make_server
+
+    service = QAService({"answer_cache": None, "max_workers": args.max_workers})
+    server = make_server("127.0.0.1", 0, service.server, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    url = f"http://127.0.0.1:{server.server_port}"
+    triples = scale_triples(args.context_size)
+
+    session = requests.Session()
+    context_id = session.post(f"{url}/kb/context", json={"context": triples}).json()[
+        "context_id"
+    ]
+
+    def ask(question: str) -> float:
+        start_time = time.perf_counter()
+        response = session.post(
+            f"{url}/kb/qa", json={"question": question, "context_id": context_id}
+        )
+        response.raise_for_status()
+        return time.perf_counter() - start_time
+
+    results = []
+    try:
+        for concurrency in args.concurrency:
+            questions = generate_questions(triples, args.requests, args.seed)
+
+            errors = 0
+            seconds = []
+            start_time = time.perf_counter()
+            with ThreadPoolExecutor(concurrency) as executor:
+                for future in [executor.submit(ask, x) for x in questions]:
+                    try:
+                        seconds.append(future.result())
+                    except Exception:
+                        errors += 1
+            elapsed = time.perf_counter() - start_time
+
+            results.append(
+                {
+                    "concurrency": concurrency,
+                    "requests": len(questions),
+                    "errors": errors,
+                    "requests_per_second": len(seconds) / elapsed,
+                    "latency": summarize(seconds),
+                }
+            )
+    finally:
+        server.shutdown()
+
+    return results
+
+
+SCENARIOS = {
+    "compact": bench_compact,
+    "retrieval": bench_retrieval,
+    "answer": bench_answer,
+    # the generated questions are lookups, without the structured fast path
+    # they are answered by the LLM pipelines
+    "answer_llm": partial(bench_answer, structured_pipeline=False),
+    "service": bench_service,
+}
+
+
+def compare(current, baseline, tolerance: float, path: str = "") -> List[dict]:
+    # slower than the baseline by more than `tolerance`, a fraction
+    regressions = []
+    if isinstance(current, dict) and isinstance(baseline, dict):
+        for key, value in current.items():
+            if key not in baseline:
+                continue
+            if key in COMPARED and isinstance(value, (int, float)):
+                limit = baseline[key] * (1 + tolerance)
+                if value > limit and value - baseline[key] > 1e-4:
+                    regressions.append(
+                        {
+                            "path": f"{path}/{key}",
+                            "baseline": baseline[key],
+                            "current": value,
+                        }
+                    )
+            else:
+                regressions += compare(value, baseline[key], tolerance, f"{path}/{key}")
+    elif isinstance(current, list) and isinstance(baseline, list):
+        for i, (x, y) in enumerate(zip(current, baseline)):
+            regressions += compare(x, y, tolerance, f"{path}/{i}")
+    return regressions
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Throughput and latency with a stand-in LLM and embedder."
+    )
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS)
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[12, 1_000, 100_000])
+    parser.add_argument("--max-index-size", type=int, default=100_000)
+    parser.add_argument("--context-size", type=int, default=1_000)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--max-workers", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--tokens-per-second", type=float, default=100.0)
+    parser.add_argument("--answer-tokens", type=int, default=12)
+    parser.add_argument("--embedding-latency", type=float, default=0.005)
+    parser.add_argument("--embedding-text-latency", type=float, default=0.0005)
+    parser.add_argument("--output", help="Write the results to this file as well.")
+    parser.add_argument("--baseline", help="Results of an earlier run to compare to.")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    fakes.install(
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        answer_tokens=args.answer_tokens,
+        embedding_latency=args.embedding_latency,
+        embedding_text_latency=args.embedding_text_latency,
+    )
+
+    report = {
+        "meta": {
+            "time": time.time(),
+            "commit": get_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "results": {},
+    }
+    for name in args.scenarios:
+        start_time = time.perf_counter()
+        report["results"][name] = SCENARIOS[name](args)
+        logging.warning(f"`{name}` done in {time.perf_counter() - start_time:.1f}s")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        report["regressions"] = compare(
+            report["results"], baseline["results"], args.tolerance
+        )
+
+    output = json.dumps(report, indent=2)
+    print(output)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+    if report.get("regressions"):
+        sys.exit(1)
@@ -0,0 +1,153 @@
+import asyncio
+import json
+import logging
+import logging.config
+import threading
+from typing import AsyncIterator, Iterator
+
+from quart import Quart, request as Request
+
+from context import UnknownContextError
+from qa import BatchAnswer
+from server import QAService
+from startup import PROFILE
+
+
+class AsyncQAService(QAService):
+    # Same API as `QAService`, served over ASGI. Questions are answered with
+    # `QAHandler.aanswer`, so a worker is not held while waiting on the LLM.
+
+    def create_server(self) -> Quart:
+        return Quart(__name__)
+
+    def setup_routes(self):
+        @self.server.route("/kb/qa", methods=["POST"])
+        async def answer() -> str:
+            request = await Request.get_json()
+            logging.info(f"Received request: {request}")
+
+            question = request["question"]
+            context = request.get("context")
+            context_id = request.get("context_id")
+
+            if request.get("stream", False):
+                try:
+                    await asyncio.to_thread(
+                        self.qa_handler.get_context, context, context_id
+                    )
+                except UnknownContextError:
+                    return self.unknown_context(context_id)
+
+                events = self.astream_events(
+                    self.qa_handler.aanswer_stream(question, context, context_id)
+                )
+                return events, 200, {"Content-Type": "text/event-stream"}
+
+            try:
+                answer = await self.qa_handler.aanswer(question, context, context_id)
+            except UnknownContextError:
+                return self.unknown_context(context_id)
+
+            response = {
+                "answer": answer,
+            }
+            return json.dumps(response)
+
+        @self.server.route("/kb/qa/batch", methods=["POST"])
+        async def answer_batch() -> str:
+            request = await Request.get_json()
+            items = self.batch_items(request)
+            logging.info(f"Received batch of {len(items)} questions")
+
+            if request.get("stream", False):
+                lines = self.abatch_lines(self.qa_handler.iter_answer_many(items))
+                return lines, 200, {"Content-Type": "application/x-ndjson"}
+
+            # answered on threads, see `QAHandler.iter_answer_many`
+            answers = await asyncio.to_thread(self.qa_handler.answer_many, items)
+
+            response = {
+                "answers": [self.format_batch_answer(x) for x in answers],
+            }
+            return json.dumps(response)
+
+        @self.server.route("/kb/stats", methods=["GET"])
+        async def stats() -> str:
+            return json.dumps(self.qa_handler.stats())
+
+        @self.server.route("/metrics", methods=["GET"])
+        async def metrics() -> str:
+            return json.dumps(self.qa_handler.metrics())
+
+        @self.server.route("/kb/context", methods=["POST"])
+        async def create_context() -> str:
+            return self.create_context(await Request.get_json())
+
+        @self.server.route("/kb/context/<context_id>", methods=["PUT"])
+        async def update_context(context_id: str) -> str:
+            return self.update_context(
+                context_id, await Request.get_json(), Request.if_match
+            )
+
+        @self.server.route("/kb/context/<context_id>", methods=["GET"])
+        async def get_context(context_id: str) -> str:
+            return self.get_context(context_id, Request.if_none_match)
+
+        @self.server.route("/kb/context/<context_id>", methods=["DELETE"])
+        async def delete_context(context_id: str) -> str:
+            return self.delete_context(context_id)
+
+    async def astream_events(self, chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+        answer = ""
+        async for chunk in chunks:
+            answer += chunk
+            yield self.format_event({"token": chunk})
+
+        yield self.format_event({"answer": answer}, event="end")
+
+    async def abatch_lines(self, answers: Iterator[BatchAnswer]) -> AsyncIterator[str]:
+        # The next answer is waited for on a thread, not on the event loop. A
+        # generator cannot be closed while that thread is in it, see `close`.
+        lock = threading.Lock()
+
+        def next_answer() -> BatchAnswer:
+            with lock:
+                return next(answers, None)
+
+        def close() -> None:
+            with lock:
+                answers.close()
+
+        try:
+            while True:
+                answer = await asyncio.to_thread(next_answer)
+                if answer is None:
+                    break
+                yield json.dumps(self.format_batch_answer(answer)) + "\n"
+        finally:
+            # e.g. the client went away, the questions not started are dropped
+            asyncio.get_running_loop().run_in_executor(None, close)
+
+    def run(self, port: int = None):
+        port = port or self.port
+        PROFILE.mark("server_ready")
+        logging.info(f"Starting async QA service on port {port}")
+        self.server.run(host="0.0.0.0", port=port, debug=False)
+
+
+def create_app(config: dict = None) -> Quart:
+    # for ASGI servers, e.g. `uvicorn --factory asgi_server:create_app`
+    config = config or {"port": 9880}
+    server = AsyncQAService(config).server
+    PROFILE.mark("server_ready")
+    return server
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+
+    config = {
+        "port": 9880,
+    }
+    service = AsyncQAService(config)
+    service.run()
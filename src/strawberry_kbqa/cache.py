@@ -0,0 +1,256 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, List, Tuple
+
+
+class LRUCache:
+    def __init__(self, max_size: int = 128, ttl: float = None) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self.data = OrderedDict()
+        self.expiry = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.data
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self.lock:
+            if key in self.data and self.is_expired(key):
+                self.data.pop(key)
+                self.expiry.pop(key)
+
+            if key not in self.data:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self.data.move_to_end(key)
+            return self.data[key]
+
+    def is_expired(self, key: Hashable) -> bool:
+        expiry = self.expiry.get(key)
+        return expiry is not None and expiry < time.monotonic()
+
+    def put(self, key: Hashable, value: Any) -> List[Tuple[Hashable, Any]]:
+        if self.max_size <= 0:
+            return [(key, value)]
+
+        evicted = []
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+
+            if self.ttl is not None:
+                self.expiry[key] = time.monotonic() + self.ttl
+
+            while len(self.data) > self.max_size:
+                evicted_key, evicted_value = self.data.popitem(last=False)
+                self.expiry.pop(evicted_key, None)
+                evicted.append((evicted_key, evicted_value))
+
+        return evicted
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self.lock:
+            self.expiry.pop(key, None)
+            return self.data.pop(key, default)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.data.clear()
+            self.expiry.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self.data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class SQLiteCache:
+    # Same interface as `LRUCache` for string values, kept in a sqlite file so
+    # that entries survive restarts and can be shared by workers on one host.
+    def __init__(self, path: str, max_size: int = 10000, ttl: float = None) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value TEXT, expiry REAL, accessed REAL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)"
+        )
+        self.connection.commit()
+
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def __contains__(self, key: str) -> bool:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+        return row is not None
+
+    def get(self, key: str, default: Any = None) -> Any:
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value, expiry FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is not None and row[1] is not None and row[1] < now:
+                self.connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self.connection.commit()
+                row = None
+
+            if row is None:
+                self.misses += 1
+                return default
+
+            self.connection.execute(
+                "UPDATE cache SET accessed = ? WHERE key = ?", (now, key)
+            )
+            self.connection.commit()
+
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, value: str) -> None:
+        if self.max_size <= 0:
+            return
+
+        now = time.time()
+        expiry = now + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                (key, value, expiry, now),
+            )
+            self.connection.execute(
+                "DELETE FROM cache WHERE key IN ("
+                "SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_size,),
+            )
+            self.connection.commit()
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            self.connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self.connection.commit()
+        return row[0] if row is not None else default
+
+    def clear(self) -> None:
+        with self.lock:
+            self.connection.execute("DELETE FROM cache")
+            self.connection.commit()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class AnswerCache:
+    def __init__(self, config: dict = None) -> None:
+        self.configure(config or {})
+
+        self.backend = self.create_backend()
+
+    def configure(self, config: dict) -> None:
+        self.config = config
+
+        # "memory", "sqlite" or None to disable
+        self.backend_name = config.get("answer_cache", "memory")
+        self.max_size = config.get("answer_cache_size", 1024)
+        self.ttl = config.get("answer_cache_ttl", 3600)
+        self.path = config.get("answer_cache_path", "answer_cache.sqlite")
+
+    def create_backend(self) -> Any:
+        if self.backend_name is None:
+            return LRUCache(0)
+
+        if self.backend_name == "memory":
+            return LRUCache(self.max_size, self.ttl)
+
+        if self.backend_name == "sqlite":
+            logging.info(f"Using answer cache at `{self.path}`")
+            return SQLiteCache(self.path, self.max_size, self.ttl)
+
+        raise ValueError(f"Unknown answer cache backend: `{self.backend_name}`")
+
+    @staticmethod
+    def normalize_question(question: str) -> str:
+        question = re.sub(r"\s+", " ", question.strip().lower())
+        return question.rstrip("?!. ")
+
+    @staticmethod
+    def hash_text(text: str) -> str:
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def make_key(
+        self, question: str, context_fingerprint: str, pipelines: List[Any]
+    ) -> str:
+        key = [
+            self.normalize_question(question),
+            context_fingerprint,
+            [
+                [
+                    getattr(pipeline, "model_name", type(pipeline).__name__),
+                    self.hash_text(getattr(pipeline, "prompt_template", "")),
+                ]
+                for pipeline in pipelines
+            ],
+        ]
+        return self.hash_text(json.dumps(key))
+
+    def get(self, key: str) -> str:
+        return self.backend.get(key)
+
+    def put(self, key: str, answer: str) -> None:
+        self.backend.put(key, answer)
+
+    def clear(self) -> None:
+        self.backend.clear()
+
+    def stats(self) -> dict:
+        return self.backend.stats()
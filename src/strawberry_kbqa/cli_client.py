@@ -1,3 +1,5 @@
+from typing import Iterator
+
 import requests
 
 from rich.console import Console
@@ -12,9 +14,20 @@ class CLIClient(QAClient):
 
         self.console = Console()
 
+    def configure(self, config: dict) -> None:
+        super().configure(config)
+
+        self.stream = config.get("stream", True)
+
     def display_message(self, sender: str, message: str) -> None:
         self.console.print(f"[{sender}] {message}\n")
 
+    def display_stream(self, sender: str, chunks: Iterator[str]) -> None:
+        self.console.print(f"[{sender}] ", end="")
+        for chunk in chunks:
+            self.console.print(chunk, end="", markup=False, soft_wrap=True)
+        self.console.print("\n")
+
     def run(self) -> None:
         self.console.print("Welcome to the CLI Chat App!", style="bold green")
 
@@ -25,6 +38,10 @@ class CLIClient(QAClient):
                 self.console.print("Goodbye!")
                 break
 
+            if self.stream:
+                self.display_stream("Server", self.stream_request(message))
+                continue
+
             response = self.send_request(message)
             self.display_message("Server", response)
 
@@ -1,29 +1,172 @@
+import json
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Iterator
+
 import requests
+from requests.adapters import HTTPAdapter
+
+from cache import LRUCache
+from context import fingerprint
 
 
 class QAClient:
     def __init__(self, config: dict) -> None:
         self.configure(config)
 
+        # context fingerprint -> context_id, a handle per context sent
+        self.context_ids = LRUCache(self.context_handles)
+        self.context_lock = threading.Lock()
+
+        # context fingerprint -> Future of the registration being sent
+        self.registrations = {}
+
+        self.session = self.create_session()
+
     def configure(self, config: dict) -> None:
         self.config = config
 
         self.host = config.get("host", "localhost")
         self.port = config.get("port", 9880)
         self.context = config.get("context", [])
+        self.use_context_handles = config.get("use_context_handles", True)
+        self.context_handles = config.get("context_handles", 128)
 
-    def send_request(self, message: str, context: list = None) -> str:
-        context = context or self.context
+        # kept-alive connections to the server, at most this many at a time
+        self.pool_size = config.get("pool_size", 10)
+        self.timeout = config.get("timeout", None)
+
+    def create_session(self) -> requests.Session:
+        session = requests.Session()
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+        return session
+
+    def close(self) -> None:
+        self.session.close()
 
-        url = f"http://{self.host}:{self.port}/kb/qa"
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def register_context(self, context: dict) -> str:
         payload = {
-            "question": message,
             "context": context,
         }
 
-        response = requests.post(url, json=payload)
+        response = self.session.post(
+            f"{self.base_url}/kb/context", json=payload, timeout=self.timeout
+        )
+        if not response.ok:
+            logging.warning(f"Failed to register context: {response.status_code}")
+            return None
+
+        return response.json()["context_id"]
+
+    def get_context_id(self, context: dict) -> str:
+        # Questions over other contexts sent at the same time each keep their
+        # own handle. One registration for the questions over the same one,
+        # sent without the lock: the others wait on its future, not the lock.
+        key = fingerprint(context)
+        with self.context_lock:
+            context_id = self.context_ids.get(key)
+            if context_id is not None:
+                return context_id
+
+            future = self.registrations.get(key)
+            registering = future is None
+            if registering:
+                future = self.registrations[key] = Future()
+
+        if not registering:
+            return future.result()
+
+        # None on failure, the waiting questions then send the context inline
+        context_id = None
+        try:
+            context_id = self.register_context(context)
+        finally:
+            with self.context_lock:
+                if context_id is not None:
+                    self.context_ids.put(key, context_id)
+                del self.registrations[key]
+            future.set_result(context_id)
+
+        return context_id
+
+    def forget_context_id(self, context: dict, context_id: str) -> None:
+        # unless another question registered the context again already
+        key = fingerprint(context)
+        with self.context_lock:
+            if self.context_ids.get(key) == context_id:
+                self.context_ids.pop(key)
+
+    def create_payload(self, message: str, context: dict) -> dict:
+        payload = {
+            "question": message,
+        }
+
+        context_id = self.get_context_id(context) if self.use_context_handles else None
+        if context_id is not None:
+            payload["context_id"] = context_id
+        else:
+            payload["context"] = context
+
+        return payload
+
+    def post_question(
+        self, message: str, context: dict, stream: bool = False
+    ) -> requests.Response:
+        url = f"{self.base_url}/kb/qa"
+
+        payload = self.create_payload(message, context)
+        payload["stream"] = stream
+
+        response = self.session.post(
+            url, json=payload, stream=stream, timeout=self.timeout
+        )
+
+        # the server forgot the handle (restart or eviction), upload it again
+        if response.status_code == 404 and "context_id" in payload:
+            # back to the pool before the retry takes a connection
+            response.close()
+
+            self.forget_context_id(context, payload["context_id"])
+            payload = self.create_payload(message, context)
+            payload["stream"] = stream
+            response = self.session.post(
+                url, json=payload, stream=stream, timeout=self.timeout
+            )
+
+        return response
+
+    def send_request(self, message: str, context: list = None) -> str:
+        context = context or self.context
+
+        response = self.post_question(message, context)
         return response.json()["answer"] if response.ok else "Server Error"
 
+    def stream_request(self, message: str, context: list = None) -> Iterator[str]:
+        context = context or self.context
+
+        response = self.post_question(message, context, stream=True)
+        if not response.ok:
+            yield "Server Error"
+            return
+
+        # server-sent events, see `QAService.format_event`
+        for line in response.iter_lines(decode_unicode=True):
+            if not line.startswith("data: "):
+                continue
+
+            data = json.loads(line[len("data: ") :])
+            if "token" in data:
+                yield data["token"]
+
 
 if __name__ == "__main__":
     config = {
@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from typing import Any, List, Tuple
+
+from langchain_core.runnables import Runnable
+
+
+class GenerationCoalescer:
+    # Generations for one model that arrive within `window` seconds of each
+    # other are sent as one `chain.batch` call, up to `max_batch_size` prompts
+    # and `max_concurrency` of them at a time. Batches run on their own threads,
+    # at most `max_batches` at once, so collecting the next one goes on.
+    def __init__(self, model_name: str, config: dict = None) -> None:
+        self.model_name = model_name
+        self.configure(config or {})
+
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_batches, thread_name_prefix=f"generate-{model_name}"
+        )
+
+        self.start_time = time.monotonic()
+        self.requests = 0
+        self.batches = 0
+        self.pending = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_generation = 0.0
+
+    def configure(self, config: dict) -> None:
+        self.config = config
+
+        self.window = config.get("generation_batch_window", 0.01)
+        self.max_batch_size = config.get("generation_batch_size", 8)
+        self.max_concurrency = config.get("generation_max_concurrency", 4)
+        self.max_batches = config.get("generation_max_batches", 2)
+        self.native_batch = config.get("generation_native_batch", False)
+
+    def submit(self, chain: Runnable, query: dict) -> Future:
+        future = Future()
+
+        with self.lock:
+            self.pending += 1
+        self.queue.put((chain, query, future, time.monotonic()))
+        self.start()
+
+        return future
+
+    def invoke(self, chain: Runnable, query: dict) -> Any:
+        return self.submit(chain, query).result()
+
+    async def ainvoke(self, chain: Runnable, query: dict) -> Any:
+        return await asyncio.wrap_future(self.submit(chain, query))
+
+    def start(self) -> None:
+        if self.thread is not None:
+            return
+
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.loop, name=f"coalesce-{self.model_name}", daemon=True
+                )
+                self.thread.start()
+
+    def loop(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            # only prompts for the same chain can share a `batch` call
+            groups = {}
+            for item in batch:
+                groups.setdefault(id(item[0]), []).append(item)
+
+            for group in groups.values():
+                self.executor.submit(self.flush, group)
+
+    def flush(self, group: List[Tuple[Runnable, dict, Future, float]]) -> None:
+        chain = group[0][0]
+
+        # callers that gave up while queued, e.g. cancelled losing pipelines
+        with self.lock:
+            self.pending -= len(group)
+        group = [item for item in group if item[2].set_running_or_notify_cancel()]
+        if not group:
+            return
+
+        start_time = time.monotonic()
+        waits = [start_time - submitted for _, _, _, submitted in group]
+
+        with self.lock:
+            self.requests += len(group)
+            self.batches += 1
+            self.total_wait += sum(waits)
+            self.max_wait = max(self.max_wait, *waits)
+
+        # `BaseLLM.batch`, and so `Ollama`, generates the prompts one after the
+        # other. Unless the model batches natively, the default `batch` of a
+        # runnable invokes the chain for each prompt on its own thread instead.
+        batch = chain.batch if self.native_batch else partial(Runnable.batch, chain)
+
+        try:
+            responses = batch(
+                [query for _, query, _, _ in group],
+                config={"max_concurrency": self.max_concurrency},
+                return_exceptions=True,
+            )
+        except Exception as e:
+            responses = [e] * len(group)
+
+        with self.lock:
+            self.total_generation += time.monotonic() - start_time
+
+        logging.debug(
+            f"`{self.model_name}`: {len(group)} generations in "
+            f"{time.monotonic() - start_time:.2f}s, waited up to {max(waits):.3f}s"
+        )
+
+        for (_, _, future, _), response in zip(group, responses):
+            if isinstance(response, Exception):
+                future.set_exception(response)
+            else:
+                future.set_result(response)
+
+    def stats(self) -> dict:
+        with self.lock:
+            elapsed = time.monotonic() - self.start_time
+            return {
+                "requests": self.requests,
+                "batches": self.batches,
+                "pending": self.pending,
+                "batch_size": self.requests / self.batches if self.batches else 0.0,
+                "average_wait": (
+                    self.total_wait / self.requests if self.requests else 0.0
+                ),
+                "max_wait": self.max_wait,
+                "average_batch_seconds": (
+                    self.total_generation / self.batches if self.batches else 0.0
+                ),
+                "requests_per_second": self.requests / elapsed if elapsed else 0.0,
+            }
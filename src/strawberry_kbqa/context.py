@@ -1,17 +1,35 @@
+import hashlib
 import json
 import logging
 import os
+import re
 import sys
+import uuid
+from itertools import islice
 from dataclasses import asdict, dataclass, field
-from typing import List
+from typing import Iterator, List
 
+from cache import LRUCache
+from timer import Timer
+from triple_store import TripleStore
 
-@dataclass
-class Context:
-    triple: List[str]
 
-    def __post_init__(self) -> None:
-        pass
+class Context:
+    # Either a standalone triple, or a view over one row of a `TripleStore`.
+    __slots__ = ("_triple", "store", "row")
+
+    def __init__(
+        self, triple: List[str] = None, store: TripleStore = None, row: int = -1
+    ) -> None:
+        self._triple = triple
+        self.store = store
+        self.row = row
+
+    @property
+    def triple(self) -> List[str]:
+        if self.store is None:
+            return self._triple
+        return self.store.get_triple(self.row)
 
     def __len__(self) -> int:
         return len(self.triple)
@@ -19,6 +37,11 @@ class Context:
     def __getitem__(self, idx) -> str:
         return self.triple[idx]
 
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Context):
+            return NotImplemented
+        return self.triple == other.triple
+
     def __str__(self) -> str:
         return str(self.triple)
 
@@ -30,71 +53,112 @@ class Context:
         return Context([x for x in triple.values()])
 
     def is_type(self) -> bool:
-        return self.triple[1].lower() == "rdf:type"
+        if self.store is None:
+            return self.triple[1].lower() == "rdf:type"
+        return self.store.is_type(self.row)
 
 
-@dataclass
 class ContextData:
-    contexts: List[Context]
+    def __init__(self, contexts: List[Context] = None, store: TripleStore = None):
+        self.store = store if store is not None else TripleStore()
 
-    def __post_init__(self) -> None:
-        pass
+        for context in contexts or []:
+            self.add_context(context)
+
+    def add_context(self, context: Context) -> None:
+        self.store.add(*context.triple[:3])
+
+    def add_triples(self, triples: dict) -> None:
+        # the first three values, other fields of a triple, e.g. a `source`,
+        # are not part of it
+        for triple in triples["triples"]:
+            self.store.add(*islice(triple.values(), 3))
+
+    def select(self, idxs: List[int]) -> List[Context]:
+        return [Context(store=self.store, row=idx) for idx in idxs]
+
+    @property
+    def contexts(self) -> List[Context]:
+        return self.select(range(len(self)))
 
     def __len__(self) -> int:
-        return len(self.contexts)
+        return len(self.store)
 
     def __getitem__(self, idx) -> Context:
-        return self.contexts[idx]
+        if isinstance(idx, slice):
+            return self.select(range(len(self))[idx])
+        return Context(store=self.store, row=range(len(self))[idx])
+
+    def __iter__(self) -> Iterator[Context]:
+        for idx in range(len(self)):
+            yield Context(store=self.store, row=idx)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, ContextData):
+            return NotImplemented
+        return self.to_list_simple() == other.to_list_simple()
 
     def __repr__(self) -> str:
         output = f"ContextData with {len(self)} contexts.\n"
-        for idx, context in enumerate(self.contexts):
-            output += f"{idx:5}: {context.triple}\n"
+        for idx, triple in enumerate(self.store.iter_triples()):
+            output += f"{idx:5}: {triple}\n"
         return output
 
     def __str__(self) -> str:
-        return "\n".join([str(x) for x in self.contexts])
+        return "\n".join([str(x) for x in self.store.iter_triples()])
 
     @staticmethod
     def from_triples(triples: dict):
-        triples = triples["triples"]
+        context_data = ContextData()
+        context_data.add_triples(triples)
 
-        contexts = []
-        for triple in triples:
-            context = Context.from_triple(triple)
-            contexts.append(context)
+        return context_data
 
-        return ContextData(contexts)
+    def get_terms(self, term_ids: List[int]) -> List[str]:
+        return [self.store.terms[term_id] for term_id in term_ids]
 
     def get_unique_subjects(self) -> List[str]:
-        subjects = []
-        for context in self.contexts:
-            subjects.append(context.triple[0])
-        return list(set(subjects))
+        return self.get_terms(self.store.subject_index.unique())
 
     def get_unique_predicates(self) -> List[str]:
-        predicates = []
-        for context in self.contexts:
-            predicates.append(context.triple[1])
-        return list(set(predicates))
+        return self.get_terms(self.store.predicate_index.unique())
+
+    def get_unique_objects(self) -> List[str]:
+        return self.get_terms(self.store.object_index.unique())
 
     def get_all_favorites(self) -> List[Context]:
         return self.get_all_with_predicate("hasFavorite")
 
     def get_all_types(self) -> List[Context]:
-        return [context for context in self.contexts if context.is_type()]
+        return self.select(self.store.type_rows())
 
     def get_all_with_subject(self, subject: str) -> List[Context]:
-        return [context for context in self.contexts if context.triple[0] == subject]
+        term_id = self.store.terms.lookup(subject)
+        return self.select(self.store.subject_index.lookup(term_id))
 
     def get_all_with_predicate(self, predicate: str) -> List[Context]:
-        return [context for context in self.contexts if context.triple[1] == predicate]
+        term_id = self.store.terms.lookup(predicate)
+        return self.select(self.store.predicate_index.lookup(term_id))
 
     def get_all_with_object(self, object: str) -> List[Context]:
-        return [context for context in self.contexts if context.triple[2] == object]
+        term_id = self.store.terms.lookup(object)
+        return self.select(self.store.object_index.lookup(term_id))
+
+    def get_all_with_subject_predicate(
+        self, subject: str, predicate: str
+    ) -> List[Context]:
+        subject_id = self.store.terms.lookup(subject)
+        predicate_id = self.store.terms.lookup(predicate)
+        return self.select(
+            [
+                row
+                for row in self.store.subject_index.lookup(subject_id)
+                if self.store.predicates[row] == predicate_id
+            ]
+        )
 
     def to_list_simple(self) -> List[List[str]]:
-        return [x.triple for x in self.contexts]
+        return list(self.store.iter_triples())
 
     def to_list_compact(self) -> List[List[str]]:
         return self.to_compact_form().to_list_simple()
@@ -105,41 +169,168 @@ class ContextData:
         context_data = ContextData.replace_subjects(context_data)
         return context_data
 
+    # Both steps below work on the term id columns of the store. The derived
+    # store shares the term dictionary, so unchanged terms are not copied.
+
     @staticmethod
     def merge_types(context_data):
-        all_types_map = {x[0]: x[2] for x in context_data.get_all_types()}
+        store = context_data.store
+        terms = store.terms
 
-        return ContextData(
-            [
-                Context(
-                    [
-                        x[0],
-                        f"{x[1]}{all_types_map.get(x[2], '')}",
-                        x[2],
-                    ]
-                )
-                for x in context_data
-                if not x.is_type()
-            ]
-        )
+        all_types_map = {
+            store.subjects[row]: store.objects[row] for row in store.type_rows()
+        }
+
+        merged_ids = {}
+
+        def merge(predicate_id: int, object_id: int) -> int:
+            key = (predicate_id, object_id)
+            if key not in merged_ids:
+                type_id = all_types_map.get(object_id)
+                type_name = terms[type_id] if type_id is not None else ""
+                merged_ids[key] = terms.intern(f"{terms[predicate_id]}{type_name}")
+            return merged_ids[key]
+
+        merged = TripleStore(terms)
+        for subject_id, predicate_id, object_id in zip(
+            store.subjects, store.predicates, store.objects
+        ):
+            if predicate_id in store.type_ids:
+                continue
+            merged.add_ids(subject_id, merge(predicate_id, object_id), object_id)
+
+        return ContextData(store=merged)
 
     @staticmethod
     def replace_subjects(context_data):
-        names_map = {x[0]: x[2] for x in context_data.get_all_with_predicate("hasName")}
+        store = context_data.store
+        terms = store.terms
 
-        return ContextData(
-            [
-                Context(
-                    [
-                        f"{names_map.get(x[0], x[0])}",
-                        x[1],
-                        f"{names_map.get(x[2], x[2])}",
-                    ]
-                )
-                for x in context_data
-                if not x.is_type()
-            ]
-        )
+        has_name_id = terms.lookup("hasName")
+        names_map = {
+            store.subjects[row]: store.objects[row]
+            for row in store.predicate_index.lookup(has_name_id)
+        }
+
+        replaced_ids = {}
+
+        def replace(term_id: int) -> int:
+            if term_id not in replaced_ids:
+                name_id = names_map.get(term_id, term_id)
+                replaced_ids[term_id] = terms.intern(f"{terms[name_id]}")
+            return replaced_ids[term_id]
+
+        replaced = TripleStore(terms)
+        for subject_id, predicate_id, object_id in zip(
+            store.subjects, store.predicates, store.objects
+        ):
+            if predicate_id in store.type_ids:
+                continue
+            replaced.add_ids(replace(subject_id), predicate_id, replace(object_id))
+
+        return ContextData(store=replaced)
+
+
+def fingerprint(triples: dict) -> str:
+    # Keys are not sorted: `Context.from_triple` reads the values of a triple in
+    # their given order, so a reordered triple is a different context.
+    payload = json.dumps(triples, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def tokenize(text: str) -> List[str]:
+    # lowercase words of a question or a term, "Timmy's" is "timmy"
+    return re.findall(r"[a-z0-9]+", text.lower().replace("'s", ""))
+
+
+def make_id(text: str) -> str:
+    # of a document, e.g. a compacted triple
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def load_triples(path: str) -> dict:
+    with open(path) as f:
+        triples = json.load(f)
+
+    # `data/triples.json` lists triples as [subject, predicate, object]
+    triples["triples"] = [
+        dict(zip(("subject", "predicate", "object"), x)) if type(x) is list else x
+        for x in triples["triples"]
+    ]
+
+    return triples
+
+
+@dataclass
+class CompactContext:
+    fingerprint: str
+    context_data: ContextData
+    compact_data: ContextData
+    context: str
+
+    # of the rendered context, equal for payloads that compact the same way
+    context_fingerprint: str = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.context_fingerprint = hashlib.sha1(
+            self.context.encode("utf-8")
+        ).hexdigest()
+
+
+class ContextCache:
+    def __init__(self, max_size: int = 32) -> None:
+        self.cache = LRUCache(max_size)
+
+    def get(self, triples: dict) -> CompactContext:
+        key = fingerprint(triples)
+
+        entry = self.cache.get(key)
+        if entry is not None:
+            return entry
+
+        with Timer("context_parsing"):
+            context_data = ContextData.from_triples(triples)
+        with Timer("compaction"):
+            compact_data = context_data.to_compact_form()
+            entry = CompactContext(key, context_data, compact_data, str(compact_data))
+
+        self.cache.put(key, entry)
+
+        return entry
+
+    def stats(self) -> dict:
+        return self.cache.stats()
+
+
+class UnknownContextError(KeyError):
+    pass
+
+
+class ContextRegistry:
+    # Contexts uploaded once by clients and referenced by `context_id` per
+    # question. The fingerprint of the triples doubles as the version (ETag).
+    def __init__(self, context_cache: ContextCache, max_size: int = 1024) -> None:
+        self.context_cache = context_cache
+        self.contexts = LRUCache(max_size)
+
+    def __contains__(self, context_id: str) -> bool:
+        return context_id in self.contexts
+
+    def get(self, context_id: str) -> CompactContext:
+        entry = self.contexts.get(context_id)
+        if entry is None:
+            raise UnknownContextError(context_id)
+        return entry
+
+    def put(self, triples: dict, context_id: str = None) -> str:
+        context_id = context_id or uuid.uuid4().hex
+
+        self.contexts.put(context_id, self.context_cache.get(triples))
+
+        return context_id
+
+    def delete(self, context_id: str) -> bool:
+        return self.contexts.pop(context_id) is not None
 
 
 if __name__ == "__main__":
@@ -0,0 +1,187 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Sequence, Tuple
+
+from langchain.storage import InMemoryStore, LocalFileStore
+from langchain_core.embeddings import Embeddings
+from langchain_core.stores import ByteStore
+
+
+class AtomicFileStore(LocalFileStore):
+    # `LocalFileStore` writes values in place, a worker reading the same key at
+    # that moment gets half an embedding. Write next to it and rename instead.
+    def mset(self, key_value_pairs: Sequence[Tuple[str, bytes]]) -> None:
+        for key, value in key_value_pairs:
+            full_path = self._get_full_path(key)
+            self._mkdir_for_store(full_path.parent)
+
+            tmp_path = full_path.with_name(
+                f"{full_path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+            )
+            tmp_path.write_bytes(value)
+            os.replace(tmp_path, full_path)
+
+
+def create_embedding_store(config: dict, name: str) -> ByteStore:
+    # in memory by default, shared by every process using `embedding_store_dir`
+    store_dir = config.get("embedding_store_dir", None)
+    if store_dir is None:
+        return InMemoryStore()
+
+    path = os.path.join(store_dir, name)
+    logging.info(f"Using embedding store at `{path}`")
+    return AtomicFileStore(path)
+
+
+class EmbeddingBatcher:
+    # Texts submitted by concurrent callers within `max_wait` seconds of each
+    # other are embedded with one call of `fn`, up to `max_batch_size` texts.
+    # Requests at least that large are embedded by the caller directly. A lone
+    # request, with nothing else queued, is sent at once without the wait.
+    def __init__(
+        self,
+        fn: Callable[[List[str]], List[List[float]]],
+        max_batch_size: int = 64,
+        max_wait: float = 0.01,
+    ) -> None:
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+        self.requests = 0
+        self.batches = 0
+        self.texts = 0
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+
+        self.requests += 1
+
+        if len(texts) >= self.max_batch_size:
+            return self.call(texts)
+
+        future = Future()
+        self.queue.put((texts, future))
+        self.start()
+
+        return future.result()
+
+    def start(self) -> None:
+        if self.thread is not None:
+            return
+
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.loop, name="embedding-batcher", daemon=True
+                )
+                self.thread.start()
+
+    def loop(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            size = len(batch[0][0])
+
+            deadline = time.monotonic() + self.max_wait
+            while size < self.max_batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    # under load, e.g. requests queued during the last call,
+                    # the others on their way are waited for
+                    timeout = deadline - time.monotonic()
+                    if len(batch) == 1 or timeout <= 0:
+                        break
+                    try:
+                        batch.append(self.queue.get(timeout=timeout))
+                    except queue.Empty:
+                        break
+                size += len(batch[-1][0])
+
+            self.flush(batch)
+
+    def flush(self, batch: List[Tuple[List[str], Future]]) -> None:
+        # Whatever goes wrong, every caller gets an answer and the loop goes
+        # on, or the callers of this and every later batch would wait forever.
+        try:
+            # the same text asked for by several callers is embedded once
+            unique = list(dict.fromkeys(text for texts, _ in batch for text in texts))
+            vectors = dict(zip(unique, self.call(unique)))
+
+            for texts, future in batch:
+                future.set_result([vectors[text] for text in texts])
+        except Exception as e:
+            logging.error(f"Failed to embed a batch of {len(batch)} requests: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    def call(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for start in range(0, len(texts), self.max_batch_size):
+            chunk = texts[start : start + self.max_batch_size]
+            chunk_vectors = self.fn(chunk)
+            if len(chunk_vectors) != len(chunk):
+                raise ValueError(
+                    f"{len(chunk_vectors)} embeddings for {len(chunk)} texts"
+                )
+            vectors += chunk_vectors
+
+            self.batches += 1
+            self.texts += len(chunk)
+
+        return vectors
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "texts": self.texts,
+            "texts_per_batch": self.texts / self.batches if self.batches else 0.0,
+        }
+
+
+class BatchingEmbeddings(Embeddings):
+    # Wraps the embeddings of `RAGPipeline` below its `CacheBackedEmbeddings`,
+    # so only cache misses are batched. Queries and documents are embedded
+    # differently by some models and are batched separately.
+    def __init__(self, embeddings: Embeddings, config: dict = None) -> None:
+        self.embeddings = embeddings
+        self.configure(config or {})
+
+        self.documents = EmbeddingBatcher(
+            embeddings.embed_documents, self.max_batch_size, self.max_wait
+        )
+        self.queries = EmbeddingBatcher(
+            self.embed_queries, self.max_batch_size, self.max_wait
+        )
+
+    def configure(self, config: dict) -> None:
+        self.config = config
+
+        self.max_batch_size = config.get("embedding_batch_size", 64)
+        self.max_wait = config.get("embedding_batch_wait", 0.01)
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        return [self.embeddings.embed_query(text) for text in texts]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.documents.embed(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.queries.embed([text])[0]
+
+    def stats(self) -> dict:
+        return {
+            "documents": self.documents.stats(),
+            "queries": self.queries.stats(),
+        }
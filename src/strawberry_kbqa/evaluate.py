@@ -0,0 +1,309 @@
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Tuple
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+from context import load_triples
+from qa import QAHandler
+from timer import Histogram, Trace, trace
+
+
+class Checkpoint:
+    # Progress over the lines of the input: every line below `done_below` is
+    # done, and so are the lines in `done` above it. Answers finish out of
+    # order, but `done` only holds those ahead of the slowest one in flight.
+    # `output_offset` is the size of the output when it was saved, anything
+    # written after it is for lines the checkpoint does not count as done.
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+        self.done_below = 0
+        self.done = set()
+        self.output_offset = 0
+
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.done_below = state["done_below"]
+            self.done = set(state["done"])
+            self.output_offset = state["output_offset"]
+
+    def __contains__(self, line: int) -> bool:
+        return line < self.done_below or line in self.done
+
+    def add(self, line: int) -> None:
+        self.done.add(line)
+        while self.done_below in self.done:
+            self.done.remove(self.done_below)
+            self.done_below += 1
+
+    def save(self, output_offset: int) -> None:
+        # a crash while saving leaves the previous checkpoint
+        self.output_offset = output_offset
+        state = {
+            "done_below": self.done_below,
+            "done": sorted(self.done),
+            "output_offset": self.output_offset,
+        }
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+class Evaluator:
+    # Answers a JSONL question set with `QAHandler` on `workers` threads and
+    # writes one JSON line per input line to the output as it is ready. At
+    # most `max_in_flight` lines are read ahead of the answers, so memory does
+    # not grow with the input. On resume, the output is cut back to where the
+    # checkpoint was saved and the lines after it are answered again, so every
+    # line is in the output exactly once. Without a checkpoint the output is
+    # started over.
+    #
+    # A line that cannot be parsed, or still fails after `retries`, e.g. no
+    # pipeline answered it, is written with an `error` and counts as done: a
+    # resume does not retry it. Rerun those lines with their own input, e.g.
+    # filtered from the output.
+    def __init__(self, config: dict) -> None:
+        self.configure(config)
+
+        self.qa_handler = QAHandler(self.config)
+
+        self.checkpoint = Checkpoint(self.checkpoint_path)
+        self.lock = threading.Lock()
+
+        self.answered = 0
+        self.errors = 0
+        self.scored = 0
+        self.correct = 0
+        self.winners = {}
+        self.latency = Histogram(self.config.get("metrics_window", 1000))
+
+    def configure(self, config: dict) -> None:
+        self.config = config
+
+        self.input_path = config["input"]
+        self.output_path = config["output"]
+        self.checkpoint_path = config.get(
+            "checkpoint", self.output_path + ".checkpoint"
+        )
+
+        self.workers = config.get("workers", 4)
+        self.max_in_flight = config.get("max_in_flight", self.workers * 4)
+        self.checkpoint_every = config.get("checkpoint_every", 100)
+
+        # attempts after the first for a question that raised, e.g. Ollama down
+        self.retries = config.get("retries", 2)
+        self.retry_wait = config.get("retry_wait", 1.0)
+
+        # for the questions with neither a `context` nor a `context_id`
+        self.default_context = config.get("default_context", None)
+
+    def register_contexts(self, path: str) -> None:
+        # JSON lines with a `context_id` and a `context`, for questions that
+        # refer to a context rather than carrying it
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    item = json.loads(line)
+                    self.qa_handler.register_context(
+                        item["context"], item["context_id"]
+                    )
+
+    def read(self) -> Iterator[Tuple[int, str]]:
+        # lines are parsed by the workers, see `evaluate`
+        with open(self.input_path) as f:
+            for line_number, line in enumerate(f):
+                if line_number in self.checkpoint:
+                    continue
+
+                # done as is, the checkpoint only moves past answered lines
+                if not line.strip():
+                    with self.lock:
+                        self.checkpoint.add(line_number)
+                    continue
+
+                yield line_number, line
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return re.sub(r"[^a-z0-9 ]", "", text.lower()).strip()
+
+    @staticmethod
+    def parse(line: str) -> dict:
+        item = json.loads(line)
+        if type(item) is not dict or type(item.get("question")) is not str:
+            raise ValueError("expected an object with a `question`")
+        return item
+
+    def answer(self, item: dict) -> Tuple[str, Trace]:
+        for attempt in range(self.retries + 1):
+            try:
+                with trace("evaluate") as request_trace:
+                    compact_context = self.qa_handler.get_context(
+                        item.get("context", self.default_context),
+                        item.get("context_id"),
+                    )
+                    answer = self.qa_handler.answer_context(
+                        item["question"], compact_context, item.get("context_id")
+                    )
+
+                # Pipelines that raise only fail their run, e.g. with Ollama
+                # down the answer is empty rather than an exception.
+                attributes = request_trace.attributes
+                if attributes.get("winner") is None and attributes.get("cache") is None:
+                    raise RuntimeError("no pipeline answered")
+
+                return answer, request_trace
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                logging.warning(f"Retrying `{item['question']}` after: {e}")
+                time.sleep(self.retry_wait * 2**attempt)
+
+    def evaluate(self, line_number: int, line: str) -> dict:
+        result = {"line": line_number}
+
+        start_time = time.perf_counter()
+        try:
+            item = self.parse(line)
+            result["id"] = item.get("id")
+            result["question"] = item["question"]
+
+            result["answer"], request_trace = self.answer(item)
+        except Exception as e:
+            logging.error(f"Failed to answer line {line_number}: {e}")
+            result["error"] = str(e)
+            return result
+        result["seconds"] = time.perf_counter() - start_time
+
+        result["winner"] = request_trace.attributes.get("winner")
+        result["cache"] = request_trace.attributes.get("cache")
+        result["stages"] = request_trace.stages()
+
+        # the expected answer is in the answer, both normalized
+        if "expected" in item:
+            result["expected"] = item["expected"]
+            result["correct"] = self.normalize(str(item["expected"])) in (
+                self.normalize(result["answer"])
+            )
+
+        return result
+
+    def record(self, result: dict, output) -> None:
+        with self.lock:
+            output.write((json.dumps(result) + "\n").encode("utf-8"))
+
+            self.answered += 1
+            if "error" in result:
+                self.errors += 1
+            else:
+                self.latency.observe(result["seconds"])
+                self.winners[result["winner"]] = (
+                    self.winners.get(result["winner"], 0) + 1
+                )
+            if "correct" in result:
+                self.scored += 1
+                self.correct += result["correct"]
+
+            # answers reach the file before the checkpoint says they are done
+            self.checkpoint.add(result["line"])
+            if self.answered % self.checkpoint_every == 0:
+                self.save(output)
+
+    def save(self, output) -> None:
+        output.flush()
+        self.checkpoint.save(output.tell())
+
+    def open_output(self):
+        # cut off what was written after the checkpoint, a torn last line too
+        with open(self.output_path, "ab") as output:
+            output.truncate(self.checkpoint.output_offset)
+        return open(self.output_path, "ab")
+
+    def run(self) -> dict:
+        start_time = time.perf_counter()
+        in_flight = threading.BoundedSemaphore(self.max_in_flight)
+
+        def work(line_number: int, line: str, output) -> None:
+            try:
+                self.record(self.evaluate(line_number, line), output)
+            except Exception as e:
+                # e.g. an answer that cannot be written, the line stays undone
+                logging.error(f"Failed to record line {line_number}: {e}")
+            finally:
+                in_flight.release()
+
+        with self.open_output() as output:
+            with ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="evaluate"
+            ) as executor:
+                for line_number, line in self.read():
+                    in_flight.acquire()
+                    executor.submit(work, line_number, line, output)
+
+            with self.lock:
+                self.save(output)
+
+        return self.summary(time.perf_counter() - start_time)
+
+    def summary(self, elapsed: float) -> dict:
+        return {
+            "answered": self.answered,
+            "errors": self.errors,
+            "seconds": elapsed,
+            "questions_per_second": self.answered / elapsed if elapsed else 0.0,
+            "accuracy": self.correct / self.scored if self.scored else None,
+            "winners": self.winners,
+            "latency": self.latency.report(),
+            "stages": self.qa_handler.metrics()["stages"],
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Answer a JSONL question set and write the answers as JSONL."
+    )
+    parser.add_argument(
+        "input",
+        help="JSON lines with a `question`, a `context` or a `context_id`, "
+        "and optionally an `id` and an `expected` answer.",
+    )
+    parser.add_argument("output", help="One JSON line per answer, continued on resume.")
+    parser.add_argument("--contexts", help="JSON lines with `context_id`, `context`.")
+    parser.add_argument("--context", help="Triples for questions without a context.")
+    parser.add_argument("--checkpoint", help="Defaults to the output + .checkpoint")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--checkpoint-every", type=int, default=100)
+    parser.add_argument("--retries", type=int, default=2)
+    parser.add_argument("--config", help="JSON file with the QAHandler config.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    config = {}
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+
+    config.update(input=args.input, output=args.output, workers=args.workers)
+    config["checkpoint_every"] = args.checkpoint_every
+    config["retries"] = args.retries
+    if args.checkpoint:
+        config["checkpoint"] = args.checkpoint
+
+    if args.context:
+        config["default_context"] = load_triples(args.context)
+
+    evaluator = Evaluator(config)
+    if args.contexts:
+        evaluator.register_contexts(args.contexts)
+
+    print(json.dumps(evaluator.run(), indent=2))
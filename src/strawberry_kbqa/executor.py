@@ -0,0 +1,48 @@
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+
+class ExecutorBusyError(RuntimeError):
+    pass
+
+
+class BoundedExecutor:
+    # A thread pool that accepts at most `max_workers + max_pending` tasks at a
+    # time. Submitting beyond that blocks for up to `submit_timeout` seconds
+    # (forever if None) and then raises `ExecutorBusyError`.
+    def __init__(self, config: dict = None) -> None:
+        self.configure(config or {})
+
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="pipeline"
+        )
+        self.semaphore = threading.BoundedSemaphore(self.max_workers + self.max_pending)
+
+    def configure(self, config: dict) -> None:
+        self.config = config
+
+        self.max_workers = config.get("max_workers", 8)
+        self.max_pending = config.get("max_pending", 32)
+        self.submit_timeout = config.get("submit_timeout", None)
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        if not self.semaphore.acquire(timeout=self.submit_timeout):
+            raise ExecutorBusyError(
+                f"{self.max_workers + self.max_pending} pipeline runs in flight"
+            )
+
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self.semaphore.release()
+            raise
+
+        future.add_done_callback(lambda _: self.semaphore.release())
+
+        return future
+
+    def shutdown(self, wait: bool = True) -> None:
+        logging.info("Shutting down pipeline executor ...")
+        self.executor.shutdown(wait=wait, cancel_futures=True)
@@ -0,0 +1,187 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Tuple
+
+import requests
+
+from client import QAClient
+from context import load_triples
+from timer import Histogram
+
+
+class LoadClient(QAClient):
+    # Replays questions against `/kb/qa`. With a `rate`, requests start on a
+    # fixed schedule whatever the server does, and latency counts from the
+    # scheduled start, so queueing behind a slow server is not hidden. Without
+    # one, `concurrency` workers send the next question as soon as they can.
+    def configure(self, config: dict) -> None:
+        super().configure(config)
+
+        self.rate = config.get("rate", None)
+        self.concurrency = config.get("concurrency", 8)
+        self.requests = config.get("requests", None)
+        self.duration = config.get("duration", None)
+
+        # a connection per worker
+        self.pool_size = config.get("pool_size", self.concurrency)
+
+    @staticmethod
+    def load_corpus(path: str) -> List[Tuple[str, dict]]:
+        # a question per line, or JSON lines with a `question` and a `context`
+        corpus = []
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+
+                if line.startswith("{"):
+                    item = json.loads(line)
+                    corpus.append((item["question"], item.get("context")))
+                else:
+                    corpus.append((line, None))
+        return corpus
+
+    def schedule(self, corpus: List[Tuple[str, dict]]) -> Iterator[Tuple[str, dict]]:
+        items = itertools.cycle(corpus)
+        if self.requests is not None:
+            return itertools.islice(items, self.requests)
+        if self.duration is None:
+            return iter(corpus)
+        return items
+
+    def ask(self, question: str, context: dict, start_time: float = None) -> tuple:
+        start_time = start_time or time.perf_counter()
+        try:
+            status = self.post_question(question, context or self.context).status_code
+        except requests.RequestException as e:
+            logging.debug(f"Request failed: {e}")
+            status = None
+        return status, time.perf_counter() - start_time
+
+    def run_rate(self, items: Iterator[Tuple[str, dict]], deadline: float) -> list:
+        start_time = time.perf_counter()
+        futures = []
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            for i, (question, context) in enumerate(items):
+                scheduled = start_time + i / self.rate
+                if scheduled >= deadline:
+                    break
+
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                futures.append(executor.submit(self.ask, question, context, scheduled))
+
+        return [x.result() for x in futures]
+
+    def run_closed(self, items: Iterator[Tuple[str, dict]], deadline: float) -> list:
+        results = []
+        lock = threading.Lock()
+
+        def work() -> None:
+            while time.perf_counter() < deadline:
+                with lock:
+                    item = next(items, None)
+                if item is None:
+                    return
+
+                result = self.ask(*item)
+                with lock:
+                    results.append(result)
+
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            for _ in range(self.concurrency):
+                executor.submit(work)
+
+        return results
+
+    def replay(self, corpus: List[Tuple[str, dict]]) -> dict:
+        items = self.schedule(corpus)
+        deadline = (
+            time.perf_counter() + self.duration if self.duration else float("inf")
+        )
+
+        start_time = time.perf_counter()
+        if self.rate:
+            results = self.run_rate(items, deadline)
+        else:
+            results = self.run_closed(items, deadline)
+        elapsed = time.perf_counter() - start_time
+
+        return self.report(results, elapsed)
+
+    def report(self, results: List[Tuple[int, float]], elapsed: float) -> dict:
+        statuses = {}
+        latency = Histogram(max(len(results), 1))
+        for status, seconds in results:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if status is not None and 200 <= status < 300:
+                latency.observe(seconds)
+
+        errors = len(results) - latency.count
+        return {
+            "requests": len(results),
+            "errors": errors,
+            "error_rate": errors / len(results) if results else 0.0,
+            "statuses": statuses,
+            "seconds": elapsed,
+            "throughput": latency.count / elapsed if elapsed else 0.0,
+            "target_rate": self.rate,
+            "concurrency": self.concurrency,
+            "latency": latency.report(),
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay a corpus of questions against `/kb/qa`."
+    )
+    parser.add_argument("corpus", help="A question per line, or JSON lines.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=9880)
+    parser.add_argument(
+        "--context",
+        default=os.path.join(
+            os.path.dirname(__file__), "..", "..", "data", "triples.json"
+        ),
+        help="Triples for the questions without a context of their own.",
+    )
+    parser.add_argument("--rate", type=float, help="Requests per second to start.")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, help="Cycle the corpus to this many.")
+    parser.add_argument("--duration", type=float, help="Seconds to keep sending.")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--no-context-handles", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    context = load_triples(args.context)
+
+    client = LoadClient(
+        {
+            "host": args.host,
+            "port": args.port,
+            "context": context,
+            "use_context_handles": not args.no_context_handles,
+            "rate": args.rate,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "duration": args.duration,
+            "timeout": args.timeout,
+        }
+    )
+
+    try:
+        report = client.replay(client.load_corpus(args.corpus))
+    finally:
+        client.close()
+
+    print(json.dumps(report, indent=2))
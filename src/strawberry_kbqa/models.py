@@ -0,0 +1,172 @@
+import logging
+import threading
+import time
+from typing import Callable, Hashable, List
+
+import requests
+from langchain_community.llms import Ollama
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import Runnable
+
+
+class ModelRegistry:
+    # Ollama clients, prompts and chains shared by every pipeline, keyed by
+    # model name and prompt template. Also tracks which models the Ollama
+    # server holds for us: `preload` loads them ahead of the first question and
+    # models idle the longest are unloaded when `memory_budget` is exceeded.
+    # Generations hold their model between `touch` and `release`, a model in
+    # use is never unloaded.
+    def __init__(self, config: dict = None) -> None:
+        self.configure(config or {})
+
+        self.llms = {}
+        self.prompts = {}
+        self.chains = {}
+
+        # model name -> last use, for models loaded through this registry
+        self.loaded = {}
+        # model name -> generations running on it
+        self.in_use = {}
+        # used for the first time, loaded by Ollama once the generation is done
+        self.loading = set()
+
+        self.lock = threading.RLock()
+        # one enforcement at a time, see `enforce_budget_later`
+        self.budget_lock = threading.Lock()
+
+    def configure(self, config: dict) -> None:
+        self.config = config
+
+        self.base_url = config.get("ollama_base_url", "http://localhost:11434")
+
+        # how long Ollama keeps an idle model, e.g. "30m", -1 for ever
+        self.keep_alive = config.get("model_keep_alive", None)
+
+        # bytes of loaded models, as reported by Ollama, None for no limit
+        self.memory_budget = config.get("model_memory_budget", None)
+
+    def get_llm(self, model_name: str) -> Ollama:
+        with self.lock:
+            if model_name not in self.llms:
+                self.llms[model_name] = Ollama(
+                    model=model_name, base_url=self.base_url, keep_alive=self.keep_alive
+                )
+            return self.llms[model_name]
+
+    def get_prompt(self, prompt_template: str) -> ChatPromptTemplate:
+        with self.lock:
+            if prompt_template not in self.prompts:
+                self.prompts[prompt_template] = ChatPromptTemplate.from_template(
+                    prompt_template
+                )
+            return self.prompts[prompt_template]
+
+    def get_chain(self, key: Hashable, create: Callable[[], Runnable]) -> Runnable:
+        with self.lock:
+            if key not in self.chains:
+                self.chains[key] = create()
+            return self.chains[key]
+
+    def touch(self, model_name: str) -> None:
+        # before a generation, `release` after it
+        with self.lock:
+            if model_name not in self.loaded:
+                self.loading.add(model_name)
+            self.loaded[model_name] = time.monotonic()
+            self.in_use[model_name] = self.in_use.get(model_name, 0) + 1
+
+    def release(self, model_name: str) -> None:
+        with self.lock:
+            self.in_use[model_name] -= 1
+            if not self.in_use[model_name]:
+                del self.in_use[model_name]
+
+            newly_loaded = model_name in self.loading
+            self.loading.discard(model_name)
+            self.loaded[model_name] = time.monotonic()
+
+        if newly_loaded and self.memory_budget is not None:
+            self.enforce_budget_later(keep=model_name)
+
+    def enforce_budget_later(self, keep: str = None) -> None:
+        # off the request, `enforce_budget` waits on Ollama
+        threading.Thread(
+            target=self.enforce_budget, args=(keep,), name="model-budget", daemon=True
+        ).start()
+
+    def preload(self, model_names: List[str]) -> None:
+        for model_name in model_names:
+            start_time = time.perf_counter()
+
+            # an empty prompt makes Ollama load the model without generating
+            self.touch(model_name)
+            try:
+                self.get_llm(model_name).invoke("")
+            finally:
+                self.release(model_name)
+
+            logging.info(
+                f"Preloaded `{model_name}` in {time.perf_counter() - start_time:.2f}s"
+            )
+
+    def unload(self, model_name: str) -> None:
+        with self.lock:
+            self.loaded.pop(model_name, None)
+        Ollama(model=model_name, base_url=self.base_url, keep_alive=0).invoke("")
+
+        logging.info(f"Unloaded `{model_name}`")
+
+    def running_models(self) -> dict:
+        response = requests.get(f"{self.base_url}/api/ps", timeout=5)
+        response.raise_for_status()
+
+        models = {}
+        for model in response.json().get("models", []):
+            name = model["name"]
+            models[name[: -len(":latest")] if name.endswith(":latest") else name] = (
+                model.get("size", 0)
+            )
+        return models
+
+    def enforce_budget(self, keep: str = None) -> None:
+        with self.budget_lock:
+            try:
+                sizes = self.running_models()
+            except Exception as e:
+                logging.warning(f"Failed to get the running models: {e}")
+                return
+
+            with self.lock:
+                # least recently used first, not the model that was just loaded
+                idle = sorted(
+                    (x for x in self.loaded if x != keep and x in sizes),
+                    key=self.loaded.get,
+                )
+
+            total = sum(sizes.values())
+            for model_name in idle:
+                if total <= self.memory_budget:
+                    break
+
+                # checked again right before, a generation may have started
+                with self.lock:
+                    if model_name in self.in_use:
+                        continue
+                    self.loaded.pop(model_name, None)
+
+                try:
+                    self.unload(model_name)
+                except Exception as e:
+                    logging.warning(f"Failed to unload `{model_name}`: {e}")
+                    continue
+                total -= sizes[model_name]
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self.lock:
+            return {
+                "llms": len(self.llms),
+                "chains": len(self.chains),
+                "in_use": dict(self.in_use),
+                "idle_seconds": {x: now - last for x, last in self.loaded.items()},
+            }
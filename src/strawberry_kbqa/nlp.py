@@ -1,33 +1,171 @@
-import nltk
-import spacy
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Iterable, List, Tuple
+
+from cache import LRUCache
+
+
+@dataclass
+class Analysis:
+    text: str
+    pos_tags: List[Tuple[str, str]]
+    entities: List[Tuple[str, str]]
+    subjects: List[str]
+    objects: List[str]
 
 
 class _NLP:
+    # spaCy and its model take seconds to import and load, and `nltk.download`
+    # goes to the network. Both happen on first use, or earlier with `load`.
+    model_name = "en_core_web_lg"
+
+    # pipeline components each kind of analysis needs, the others are disabled
+    components = {
+        "pos": {"tok2vec", "tagger", "attribute_ruler"},
+        "ner": {"tok2vec", "ner"},
+        "deps": {"tok2vec", "parser"},
+        "all": {"tok2vec", "tagger", "attribute_ruler", "parser", "ner"},
+    }
+
     def __init__(self):
-        self.nlp = spacy.load("en_core_web_lg")
-        nltk.download("punkt")
+        self._nlp = None
+        self.load_lock = threading.Lock()
+
+        self.docs = None
+        self.configure({})
+
+    def configure(self, config: dict) -> None:
+        # Shared by every handler in the process, each configures it. The docs
+        # parsed so far are kept unless the cache size changes.
+        self.config = config
+
+        self.batch_size = config.get("nlp_batch_size", 64)
+        self.n_process = config.get("nlp_n_process", 1)
+
+        # parsed docs by (kind, text)
+        cache_size = config.get("nlp_cache_size", 1024)
+        if self.docs is None or self.docs.max_size != cache_size:
+            self.docs = LRUCache(cache_size)
+
+    @property
+    def nlp(self):
+        if self._nlp is None:
+            self.load()
+        return self._nlp
+
+    def is_loaded(self) -> bool:
+        return self._nlp is not None
+
+    def load(self) -> None:
+        with self.load_lock:
+            if self._nlp is not None:
+                return
+
+            start_time = time.perf_counter()
+
+            import nltk
+            import spacy
+
+            try:
+                nltk.data.find("tokenizers/punkt")
+            except LookupError:
+                nltk.download("punkt")
 
-        self.doc = None
+            self._nlp = spacy.load(self.model_name)
 
-    def pos_tag(self, text: str = None):
-        self.doc = self.nlp(text) if text else self.doc
-        return [(token.text, token.pos_) for token in self.doc]
+            logging.info(
+                f"Loaded `{self.model_name}` in {time.perf_counter() - start_time:.2f}s"
+            )
 
-    def ner(self, text: str = None):
-        self.doc = self.nlp(text) if text else self.doc
-        return [(ent.text, ent.label_) for ent in self.doc.ents]
+    def get_doc(self, kind: str, text: str) -> Any:
+        # a doc parsed with every component serves any kind of analysis
+        doc = self.docs.get(("all", text)) if kind != "all" else None
+        return doc if doc is not None else self.docs.get((kind, text))
 
-    def get_subject_object(self, text: str = None):
-        self.doc = self.nlp(text) if text else self.doc
+    def parse(self, texts: Iterable[str], kind: str = "all") -> List[Any]:
+        texts = list(texts)
+
+        docs = [self.get_doc(kind, x) for x in texts]
+
+        missing = list(dict.fromkeys(x for x, doc in zip(texts, docs) if doc is None))
+        if missing:
+            disable = [x for x in self.nlp.pipe_names if x not in self.components[kind]]
+            parsed = dict(
+                zip(
+                    missing,
+                    self.nlp.pipe(
+                        missing,
+                        disable=disable,
+                        batch_size=self.batch_size,
+                        n_process=self.n_process,
+                    ),
+                )
+            )
+            for text, doc in parsed.items():
+                self.docs.put((kind, text), doc)
+
+            docs = [
+                doc if doc is not None else parsed[x] for x, doc in zip(texts, docs)
+            ]
+
+        return docs
+
+    @staticmethod
+    def get_pos_tags(doc: Any) -> List[Tuple[str, str]]:
+        return [(token.text, token.pos_) for token in doc]
+
+    @staticmethod
+    def get_entities(doc: Any) -> List[Tuple[str, str]]:
+        return [(ent.text, ent.label_) for ent in doc.ents]
+
+    @staticmethod
+    def get_subjects_objects(doc: Any) -> Tuple[List[str], List[str]]:
         subs = []
         objs = []
-        for token in self.doc:
+        for token in doc:
             if "subj" in token.dep_:
                 subs.append(token.text)
             elif "obj" in token.dep_:
                 objs.append(token.text)
         return subs, objs
 
+    def analyse(self, texts: Iterable[str]) -> List[Analysis]:
+        analyses = []
+        for doc in self.parse(texts, "all"):
+            subs, objs = self.get_subjects_objects(doc)
+            analyses.append(
+                Analysis(
+                    text=doc.text,
+                    pos_tags=self.get_pos_tags(doc),
+                    entities=self.get_entities(doc),
+                    subjects=subs,
+                    objects=objs,
+                )
+            )
+        return analyses
+
+    def pos_tag_many(self, texts: Iterable[str]) -> List[List[Tuple[str, str]]]:
+        return [self.get_pos_tags(doc) for doc in self.parse(texts, "pos")]
+
+    def ner_many(self, texts: Iterable[str]) -> List[List[Tuple[str, str]]]:
+        return [self.get_entities(doc) for doc in self.parse(texts, "ner")]
+
+    def get_subject_object_many(
+        self, texts: Iterable[str]
+    ) -> List[Tuple[List[str], List[str]]]:
+        return [self.get_subjects_objects(doc) for doc in self.parse(texts, "deps")]
+
+    def pos_tag(self, text: str):
+        return self.pos_tag_many([text])[0]
+
+    def ner(self, text: str):
+        return self.ner_many([text])[0]
+
+    def get_subject_object(self, text: str):
+        return self.get_subject_object_many([text])[0]
+
 
 NLP = _NLP()
 
@@ -38,3 +176,4 @@ if __name__ == "__main__":
     print(NLP.pos_tag(sentence))
     print(NLP.ner(sentence))
     print(NLP.get_subject_object(sentence))
+    print(NLP.analyse([sentence, "How old is Timmy?", "Where does Tommy live?"]))
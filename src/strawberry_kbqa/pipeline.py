@@ -1,10 +1,24 @@
+import asyncio
+import contextvars
 import json
 import logging
 import os
 import re
 import sys
 import threading
-from typing import Any, Iterable, List
+import time
+from concurrent.futures import CancelledError, Future, TimeoutError
+from dataclasses import dataclass
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    Tuple,
+    Union,
+)
 
 sys.path.append(os.path.abspath(os.path.dirname(__file__)))
 
@@ -19,23 +33,126 @@ from langchain_community.vectorstores import FAISS
 from langchain_core.documents import Document
 from langchain_core.embeddings import Embeddings
 from langchain_core.prompts import ChatPromptTemplate, SystemMessagePromptTemplate
-from langchain_core.runnables import Runnable
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import Runnable, RunnableLambda
+from cache import LRUCache
+from coalescer import GenerationCoalescer
+from context import ContextData
+from embeddings import BatchingEmbeddings, create_embedding_store
+from executor import BoundedExecutor
+from models import ModelRegistry
+from nlp import NLP
+from retriever import BM25Index, GraphRetriever, HybridRetriever
 from timer import Timer, measure_time
+from vector_store import IncrementalVectorStore, VectorStoreCache
+
+
+@dataclass
+class PipelineResult:
+    raw_result: str = ""
+    success: bool = False
+    elapsed: float = 0.0
+
+    @property
+    def result(self) -> str:
+        return self.raw_result if self.success else ""
+
+
+# the run a pipeline is invoked for on the executor, see `BasePipeline.submit`
+current_run = contextvars.ContextVar("current_run", default=None)
+
+
+class PipelineRun:
+    # One invocation of a pipeline, carrying its own result. A run already
+    # started is cancelled through the futures it waits on, see `track`.
+    def __init__(self, pipeline: "BasePipeline", future: Future = None) -> None:
+        self.pipeline = pipeline
+        self.future = future
+
+        self.waiting = []
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def is_running(self) -> bool:
+        return not self.future.done()
+
+    def track(self, future: Future) -> None:
+        # e.g. a generation queued on a `GenerationCoalescer`
+        with self.lock:
+            self.waiting.append(future)
+            cancelled = self.cancelled
+        if cancelled:
+            future.cancel()
+
+    def cancel(self) -> bool:
+        if self.future.cancel():
+            return True
+
+        with self.lock:
+            self.cancelled = True
+            waiting = list(self.waiting)
+
+        # a generation not sent yet is dropped, one being generated is not
+        return any([future.cancel() for future in waiting])
+
+    def add_done_callback(self, fn: Callable) -> None:
+        self.future.add_done_callback(lambda _: fn(self))
+
+    def join(self, timeout: float = None) -> PipelineResult:
+        if self.future.cancelled():
+            return PipelineResult()
+
+        try:
+            return self.future.result(timeout=timeout)
+        except TimeoutError:
+            raise
+        except CancelledError:
+            return PipelineResult()
+        except Exception as e:
+            logging.error(f"`{type(self.pipeline).__name__}` failed: {e}")
+            return PipelineResult()
+
+    @property
+    def success(self) -> bool:
+        return self.join().success
+
+    @property
+    def raw_result(self) -> str:
+        return self.join().raw_result
+
+    @property
+    def result(self) -> str:
+        return self.join().result
 
 
 class BasePipeline:
+    # shared by every pipeline, see `get_executor`
+    executor = None
+    executor_lock = threading.Lock()
+
+    # one per model name, see `get_coalescer`
+    coalescers = {}
+
+    # see `get_models`
+    models = None
+
+    # see `StructuredPipeline`
+    inline = False
+
     def __init__(self, config: dict) -> None:
 
         self.configure(config)
 
         self.llm = self.create_llm()
         self.prompt = self.create_prompt()
-        self.chain = self.create_chain()
 
-        self.thread = None
-        self.raw_result = None
-
-        self.success = False
+        # pipelines building the same chain for the same model and prompt share it
+        key = (
+            type(self).create_chain.__qualname__,
+            self.model_name,
+            self.prompt_template,
+        )
+        self.chain = self.get_models(config).get_chain(key, self.create_chain)
 
     def configure(self, config: dict) -> None:
         logging.debug(f"Configuring with: `{config}` ...")
@@ -44,6 +161,31 @@ class BasePipeline:
         self.model_name = config["model_name"]
         self.prompt_template = config["prompt_template"]
 
+        self.generation_batching = config.get("generation_batching", False)
+
+    @classmethod
+    def get_executor(cls, config: dict = None) -> BoundedExecutor:
+        with BasePipeline.executor_lock:
+            if BasePipeline.executor is None:
+                BasePipeline.executor = BoundedExecutor(config)
+        return BasePipeline.executor
+
+    @classmethod
+    def get_coalescer(cls, model_name: str, config: dict = None) -> GenerationCoalescer:
+        with BasePipeline.executor_lock:
+            if model_name not in BasePipeline.coalescers:
+                BasePipeline.coalescers[model_name] = GenerationCoalescer(
+                    model_name, config
+                )
+        return BasePipeline.coalescers[model_name]
+
+    @classmethod
+    def get_models(cls, config: dict = None) -> ModelRegistry:
+        with BasePipeline.executor_lock:
+            if BasePipeline.models is None:
+                BasePipeline.models = ModelRegistry(config)
+        return BasePipeline.models
+
     def create_chain(
         self, llm: Ollama = None, prompt: ChatPromptTemplate = None
     ) -> Runnable:
@@ -54,54 +196,143 @@ class BasePipeline:
 
     def create_llm(self, model_name: str = None) -> Ollama:
         model_name = model_name or self.model_name
-        llm = Ollama(model=model_name)
+        llm = self.get_models(self.config).get_llm(model_name)
 
         return llm
 
     def create_prompt(self, prompt_template: str = None) -> ChatPromptTemplate:
         prompt_template = prompt_template or self.prompt_template
-        prompt = ChatPromptTemplate.from_template(prompt_template)
+        prompt = self.get_models(self.config).get_prompt(prompt_template)
 
         return prompt
 
+    def warm_up(self) -> None:
+        self.get_models(self.config).preload([self.model_name])
+
     def process_response(self, response: Any) -> str:
         result = response if type(response) is str else response["answer"]
         return result
 
-    @measure_time
-    def _invoke(self, query: dict, chain: Runnable) -> None:
-        response = chain.invoke(query)
-        self.raw_result = self.process_response(response)
-        self.success = not self.has_failed()
+    def process_chunk(self, chunk: Any) -> str:
+        # retrieval chains stream dicts, the answer tokens come under `answer`
+        result = chunk if type(chunk) is str else chunk.get("answer", "")
+        return result
+
+    def create_result(self, response: Any, start_time: float) -> PipelineResult:
+        raw_result = self.process_response(response)
+
+        with Timer("validation", pipeline=type(self).__name__):
+            success = not self.has_failed(raw_result)
+
+        return PipelineResult(
+            raw_result=raw_result,
+            success=success,
+            elapsed=time.perf_counter() - start_time,
+        )
 
-    def _run(self, *args, **kwargs) -> None:
-        th = threading.Thread(target=self._invoke, args=[*args], kwargs={**kwargs})
-        th.start()
+    def _invoke(self, query: dict, chain: Runnable) -> PipelineResult:
+        start_time = time.perf_counter()
+        models = self.get_models(self.config)
+
+        models.touch(self.model_name)
+        try:
+            with Timer(
+                "generation", pipeline=type(self).__name__, model=self.model_name
+            ):
+                if self.generation_batching:
+                    coalescer = self.get_coalescer(self.model_name, self.config)
+                    future = coalescer.submit(chain, query)
+
+                    # cancelled with the run, e.g. when another pipeline won
+                    run = current_run.get()
+                    if run is not None:
+                        run.track(future)
+                    response = future.result()
+                else:
+                    response = chain.invoke(query)
+        finally:
+            models.release(self.model_name)
+
+        return self.create_result(response, start_time)
+
+    async def _ainvoke(self, query: dict, chain: Runnable) -> PipelineResult:
+        start_time = time.perf_counter()
+        models = self.get_models(self.config)
+
+        models.touch(self.model_name)
+        try:
+            with Timer(
+                "generation", pipeline=type(self).__name__, model=self.model_name
+            ):
+                if self.generation_batching:
+                    coalescer = self.get_coalescer(self.model_name, self.config)
+                    response = await coalescer.ainvoke(chain, query)
+                else:
+                    response = await chain.ainvoke(query)
+        finally:
+            models.release(self.model_name)
+
+        return self.create_result(response, start_time)
+
+    def submit(self, fn: Callable, *args, **kwargs) -> PipelineRun:
+        # with the context copied, so that spans go to the trace of the request
+        run = PipelineRun(self)
+        context = contextvars.copy_context()
+        context.run(current_run.set, run)
+
+        run.future = self.get_executor(self.config).submit(
+            context.run, fn, *args, **kwargs
+        )
+        return run
 
-        self.thread = th
+    def _run(self, *args, **kwargs) -> PipelineRun:
+        return self.submit(self._invoke, *args, **kwargs)
 
-    def run(self, query: dict, chain: Runnable = None) -> None:
+    def run(self, query: dict, chain: Runnable = None) -> PipelineRun:
         chain = chain or self.chain
-        self._run(query=query, chain=chain)
+        return self._run(query=query, chain=chain)
 
-    def is_running(self) -> bool:
-        return self.thread.is_alive()
+    async def arun(self, query: dict, chain: Runnable = None) -> PipelineResult:
+        chain = chain or self.chain
+        return await self._ainvoke(query=query, chain=chain)
 
-    def has_failed(self) -> bool:
+    def stream(self, query: dict, chain: Runnable = None) -> Iterator[str]:
+        chain = chain or self.chain
+        models = self.get_models(self.config)
+
+        models.touch(self.model_name)
+        try:
+            with Timer(
+                "generation", pipeline=type(self).__name__, model=self.model_name
+            ):
+                for chunk in chain.stream(query):
+                    text = self.process_chunk(chunk)
+                    if text:
+                        yield text
+        finally:
+            models.release(self.model_name)
+
+    async def astream(self, query: dict, chain: Runnable = None) -> AsyncIterator[str]:
+        chain = chain or self.chain
+        models = self.get_models(self.config)
+
+        models.touch(self.model_name)
+        try:
+            with Timer(
+                "generation", pipeline=type(self).__name__, model=self.model_name
+            ):
+                async for chunk in chain.astream(query):
+                    text = self.process_chunk(chunk)
+                    if text:
+                        yield text
+        finally:
+            models.release(self.model_name)
+
+    def has_failed(self, raw_result: str) -> bool:
         return any(
-            [
-                x in self.raw_result
-                for x in ["sorry", "does not", "not", "cannot", "unable"]
-            ]
+            [x in raw_result for x in ["sorry", "does not", "not", "cannot", "unable"]]
         )
 
-    def join(self) -> None:
-        self.thread.join()
-
-    @property
-    def result(self) -> str:
-        return self.raw_result if self.success else ""
-
 
 class ResponseValidationPipeline(BasePipeline):
 
@@ -189,13 +420,27 @@ Question: {input}"""
             "prompt_template": Pipeline.default_prompt_template,
         }
 
-    def run(self, query: dict, *args, **kwargs) -> None:
+    def run(self, query: dict, *args, **kwargs) -> PipelineRun:
         return super().run(query)
 
+    async def arun(self, query: dict, *args, **kwargs) -> PipelineResult:
+        return await super().arun(query)
+
+    def stream(self, query: dict, *args, **kwargs) -> Iterator[str]:
+        return super().stream(query)
+
+    def astream(self, query: dict, *args, **kwargs) -> AsyncIterator[str]:
+        return super().astream(query)
+
 
 class RAGPipeline(BasePipeline):
-    default_embeddings = OllamaEmbeddings()
+    # see `get_default_embeddings`
+    default_embeddings = None
     default_model_name = "llama2"
+
+    # the incremental index of the contexts without a handle, see
+    # `get_incremental_index`
+    inline_key = ("inline",)
     default_prompt_template = """You are Haru, a social robot. Answer the following question based only on the provided context.
 Follow these instructions:
 - Use less than three sentences, preferably one.
@@ -230,11 +475,25 @@ Question: {input}"""
         config = config or self.get_default_config()
         super().__init__(config)
 
-        self.current_embeddings = RAGPipeline.default_embeddings
+        self.current_embeddings = self.get_default_embeddings()
 
-        self.local_store = InMemoryStore()
+        self.local_store = create_embedding_store(self.config, "documents")
+        self.query_store = create_embedding_store(self.config, "queries")
 
-        self.cached_embedder = self.create_cache(RAGPipeline.default_embeddings)
+        self.cached_embedder = self.create_cache(self.current_embeddings)
+
+        self.index_cache = VectorStoreCache(self.config)
+        self.lexical_cache = LRUCache(self.config.get("lexical_cache_size", 16))
+
+        # the incremental indexes of the last contexts, by context handle, see
+        # `get_incremental_index`
+        self.incremental_indexes = LRUCache(self.incremental_index_size)
+        self.incremental_lexicals = LRUCache(self.incremental_index_size)
+        self.incremental_lock = threading.Lock()
+
+        self.graph_retriever = (
+            GraphRetriever(self.config) if self.graph_retrieval else None
+        )
 
     def configure(self, config: dict) -> None:
         if "model_name" not in config:
@@ -243,9 +502,41 @@ Question: {input}"""
         if "prompt_template" not in config:
             config["prompt_template"] = RAGPipeline.default_prompt_template
 
+        self.incremental = config.get("incremental_index", False)
+        self.incremental_index_size = config.get("incremental_index_size", 16)
+        self.embedding_batching = config.get("embedding_batching", True)
+        self.graph_retrieval = config.get("graph_retrieval", False)
+
+        # "vector", "hybrid" (BM25 and vector) or "lexical" (BM25, no embedding)
+        self.retrieval_mode = config.get("retrieval_mode", "vector")
+        self.retrieval_k = config.get("retrieval_k", 16)
+        if self.retrieval_mode not in ("vector", "hybrid", "lexical"):
+            raise ValueError(f"Unknown retrieval mode: `{self.retrieval_mode}`")
+
         return super().configure(config)
 
+    @classmethod
+    def get_default_embeddings(cls) -> Embeddings:
+        # created on first use rather than when this module is imported
+        if RAGPipeline.default_embeddings is None:
+            RAGPipeline.default_embeddings = OllamaEmbeddings()
+        return RAGPipeline.default_embeddings
+
+    def warm_up(self) -> None:
+        super().warm_up()
+
+        self.cached_embedder.embed_query("warm up")
+
+        if self.graph_retriever is not None:
+            NLP.load()
+
+    @measure_time(name="splitting")
     def create_documents(self, data: str) -> List[Document]:
+        if self.retrieval_mode == "hybrid":
+            # ranked together with BM25, one document per compacted triple
+            lines = data.splitlines() or [""]
+            return [Document(page_content=line) for line in lines]
+
         text_splitter = RecursiveCharacterTextSplitter()
         documents = [Document(page_content=data)]
         splitted_documents = text_splitter.split_documents(documents)
@@ -261,28 +552,245 @@ Question: {input}"""
 
     def create_cache(self, embeddings: Embeddings) -> CacheBackedEmbeddings:
         self.current_embeddings = embeddings
+
+        underlying = embeddings
+        if self.embedding_batching:
+            underlying = BatchingEmbeddings(embeddings, self.config)
+
         return CacheBackedEmbeddings.from_bytes_store(
-            embeddings, self.local_store, namespace=embeddings.model
+            underlying,
+            self.local_store,
+            namespace=embeddings.model,
+            query_embedding_cache=self.query_store,
         )
 
     def create_retrieval_chain(
-        self, context: str, embeddings: Embeddings = None
+        self, context: str, embeddings: Embeddings = None, context_key: str = None
     ) -> Runnable:
         embeddings = embeddings or self.current_embeddings
 
         if embeddings != self.current_embeddings:
             logging.info("Creating new cache ...")
             self.cached_embedder = self.create_cache(embeddings)
+            self.incremental_indexes.clear()
+
+        retriever = self.create_retriever(context, context_key)
+
+        def retrieve(query: dict) -> List[Document]:
+            with Timer("retrieval", mode=self.retrieval_mode):
+                return retriever.invoke(query["input"])
+
+        return create_retrieval_chain(RunnableLambda(retrieve), self.chain)
+
+    def create_retriever(self, context: str, context_key: str = None) -> BaseRetriever:
+        # Pinned to the lines of this context: an incremental index may be
+        # updated to another context before the search, e.g. an inline one.
+        texts = None
+        if self.incremental:
+            texts = context.splitlines()
+
+        if self.retrieval_mode == "vector":
+            search_kwargs = {"texts": texts} if texts is not None else {}
+            return self.create_vector_store(context, context_key).as_retriever(
+                search_kwargs=search_kwargs
+            )
+
+        vector = None
+        if self.retrieval_mode == "hybrid":
+            search_kwargs = {"k": self.retrieval_k}
+            if texts is not None:
+                search_kwargs["texts"] = texts
+            vector = self.create_vector_store(context, context_key).as_retriever(
+                search_kwargs=search_kwargs
+            )
+
+        return HybridRetriever(
+            lexical=self.create_lexical_index(context, context_key),
+            vector=vector,
+            k=self.retrieval_k,
+            texts=texts,
+            key=BM25Index.make_key(texts) if texts is not None else None,
+        )
 
-        documents = self.create_documents(context)
-        db = FAISS.from_documents(documents, self.cached_embedder)
-
-        return create_retrieval_chain(db.as_retriever(), self.chain)
+    def get_incremental_index(
+        self, indexes: LRUCache, context_key: str, create: Callable
+    ) -> Any:
+        # An index per context handle, updated with the changes of its context.
+        # Contexts without a handle, e.g. of `QAHandler.answer`, share one, so
+        # that a payload is diffed against the one before it.
+        context_key = context_key if context_key is not None else self.inline_key
+        with self.incremental_lock:
+            index = indexes.get(context_key)
+            if index is None:
+                index = create()
+                indexes.put(context_key, index)
+        return index
+
+    def create_lexical_index(self, context: str, context_key: str = None) -> BM25Index:
+        if self.incremental:
+            index = self.get_incremental_index(
+                self.incremental_lexicals,
+                context_key,
+                BM25Index,
+            )
+            return index.update(context.splitlines())
+
+        key = VectorStoreCache.make_key(context, "bm25")
+
+        index = self.lexical_cache.get(key)
+        if index is None:
+            index = BM25Index().update(context.splitlines())
+            self.lexical_cache.put(key, index)
+
+        return index
+
+    def create_vector_store(
+        self, context: str, context_key: str = None
+    ) -> Union[FAISS, IncrementalVectorStore]:
+        model_name = self.current_embeddings.model
+        if self.retrieval_mode == "hybrid":
+            model_name += ":triples"
+
+        key = VectorStoreCache.make_key(context, model_name)
+
+        if self.incremental:
+            # one document per compacted triple, see `ContextData.__str__`
+            index = self.get_incremental_index(
+                self.incremental_indexes,
+                context_key,
+                lambda: IncrementalVectorStore(self.cached_embedder),
+            )
+            return index.update(context.splitlines())
+
+        db = self.index_cache.get(key, self.cached_embedder)
+        if db is not None:
+            return db
 
-    def run(self, query: dict, context: str) -> None:
-        retrieval_chain = self.create_retrieval_chain(context)
+        documents = self.create_documents(context)
+        texts = [x.page_content for x in documents]
+
+        # embedded first rather than by `FAISS.from_documents`, to time both
+        with Timer("embedding"):
+            vectors = self.cached_embedder.embed_documents(texts)
+        with Timer("faiss_build"):
+            db = FAISS.from_embeddings(
+                list(zip(texts, vectors)),
+                self.cached_embedder,
+                metadatas=[x.metadata for x in documents],
+            )
+
+        self.index_cache.put(key, db)
+
+        return db
+
+    def retrieve_neighborhood(
+        self, query: dict, context_data: ContextData = None
+    ) -> List[Document]:
+        if self.graph_retriever is None or context_data is None:
+            return []
+
+        with Timer("retrieval", mode="graph"):
+            triples = self.graph_retriever.retrieve(query["input"], context_data)
+        if not triples:
+            return []
+
+        return [Document(page_content="\n".join(str(x) for x in triples))]
+
+    def create_context_chain(
+        self,
+        query: dict,
+        context: str,
+        context_data: ContextData = None,
+        context_key: str = None,
+    ) -> Tuple[dict, Runnable]:
+        # The neighborhood of the entities in the question fits the prompt as
+        # is. Without one, the whole context goes through the retriever.
+        documents = self.retrieve_neighborhood(query, context_data)
+        if documents:
+            return {**query, "context": documents}, self.chain
+
+        if not self.generation_batching:
+            return query, self.create_retrieval_chain(context, context_key=context_key)
+
+        # retrieved here rather than in a retrieval chain, so that every
+        # generation goes through the same chain and can be batched with others
+        retriever = self.create_retriever(context, context_key)
+        with Timer("retrieval", mode=self.retrieval_mode):
+            documents = retriever.invoke(query["input"])
+
+        return {**query, "context": documents}, self.chain
+
+    def invoke_with_context(
+        self,
+        query: dict,
+        context: str,
+        context_data: ContextData = None,
+        context_key: str = None,
+    ) -> PipelineResult:
+        query, chain = self.create_context_chain(
+            query, context, context_data, context_key
+        )
+        return self._invoke(query=query, chain=chain)
+
+    def run(
+        self,
+        query: dict,
+        context: str,
+        context_data: ContextData = None,
+        context_key: str = None,
+        **kwargs,
+    ) -> PipelineRun:
+        # the retrieval chain is built on the executor as well, so that the
+        # other pipelines do not wait for the context to be indexed
+        return self.submit(
+            self.invoke_with_context,
+            query=query,
+            context=context,
+            context_data=context_data,
+            context_key=context_key,
+        )
 
-        super().run(query, chain=retrieval_chain)
+    async def arun(
+        self,
+        query: dict,
+        context: str,
+        context_data: ContextData = None,
+        context_key: str = None,
+        **kwargs,
+    ) -> PipelineResult:
+        # indexing is blocking (FAISS, the caches), keep it off the event loop
+        query, chain = await asyncio.to_thread(
+            self.create_context_chain, query, context, context_data, context_key
+        )
+        return await self._ainvoke(query=query, chain=chain)
+
+    def stream(
+        self,
+        query: dict,
+        context: str,
+        context_data: ContextData = None,
+        context_key: str = None,
+        **kwargs,
+    ) -> Iterator[str]:
+        # a generator, so that indexing fails where the stream is read
+        query, chain = self.create_context_chain(
+            query, context, context_data, context_key
+        )
+        yield from super().stream(query, chain=chain)
+
+    async def astream(
+        self,
+        query: dict,
+        context: str,
+        context_data: ContextData = None,
+        context_key: str = None,
+        **kwargs,
+    ) -> AsyncIterator[str]:
+        query, chain = await asyncio.to_thread(
+            self.create_context_chain, query, context, context_data, context_key
+        )
+        async for text in super().astream(query, chain=chain):
+            yield text
 
     @classmethod
     def get_default_config(self) -> dict:
@@ -343,14 +851,14 @@ if __name__ == "__main__":
     query = {
         "input": "How old is he?",
     }
-    pipe.run(query, "")
-    pipe.join()
-    print(pipe.result)
+    run = pipe.run(query, "")
+    print(run.join().result)
 
     query = {
         "input": "How old is Timmy?",
     }
-    with Timer("RAGPipeline"):
-        pipe.run(query, context)
-        pipe.join()
-    print(pipe.result)
+    with Timer("RAGPipeline") as timer:
+        run = pipe.run(query, context)
+        result = run.join()
+    print(result.result)
+    print(f"`RAGPipeline` execution time: {timer.elapsed:.3f} seconds")
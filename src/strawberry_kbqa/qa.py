@@ -1,12 +1,116 @@
+import asyncio
 import json
+import queue
 import logging
 import os
+import re
 import sys
-from typing import Any, Iterable, List
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Iterable, Iterator, List, Tuple
 
-from context import Context, ContextData
+from cache import AnswerCache
+from context import (
+    CompactContext,
+    Context,
+    ContextCache,
+    ContextData,
+    ContextRegistry,
+    UnknownContextError,
+    fingerprint,
+)
 from nlp import NLP
-from pipeline import Pipeline, RAGPipeline
+from pipeline import BasePipeline, Pipeline, PipelineRun, RAGPipeline
+from startup import PROFILE
+from structured import StructuredPipeline
+from timer import METRICS, annotate, measure_time, trace
+from vector_store import SemanticAnswerCache
+
+
+@dataclass
+class RaceRecord:
+    winner: str
+    elapsed: float
+    abandoned: List[str] = field(default_factory=list)
+    cancelled: List[str] = field(default_factory=list)
+
+    # streamed part of an answer, then raised
+    interrupted: str = None
+
+    # how much later the abandoned pipelines finished, filled in once they do
+    saved: float = None
+
+
+@dataclass
+class BatchAnswer:
+    index: int
+    answer: str = None
+    error: str = None
+
+
+@dataclass
+class CacheLookup:
+    key: str
+    scope: str = None
+    vector: Any = None
+    entities: frozenset = frozenset()
+
+
+class StreamGate:
+    # Holds back the start of a streamed answer until it is long enough to be
+    # checked with `has_failed`. A refusal in that prefix lets the handler fall
+    # back to the next pipeline, anything after it is passed through as is.
+    sentence_end = re.compile(r"[.!?](\s|$)")
+
+    def __init__(self, pipeline: Any, min_prefix: int) -> None:
+        self.pipeline = pipeline
+        self.min_prefix = min_prefix
+
+        self.prefix = ""
+        self.text = ""
+
+        self.committed = False
+        self.failed = False
+
+        # raised by the stream, a fallback unless part of the answer is out
+        self.error = None
+
+    def feed(self, chunk: str) -> str:
+        if self.committed:
+            self.text += chunk
+            return chunk
+
+        self.prefix += chunk
+        if self.pipeline.has_failed(self.prefix):
+            self.failed = True
+            return ""
+
+        if len(self.prefix) >= self.min_prefix or self.sentence_end.search(self.prefix):
+            return self.commit()
+
+        return ""
+
+    def finish(self) -> str:
+        if self.committed or self.failed:
+            return ""
+
+        # nothing was streamed at all, e.g. by `StructuredPipeline`
+        if self.pipeline.has_failed(self.prefix):
+            self.failed = True
+            return ""
+
+        return self.commit()
+
+    def commit(self) -> str:
+        self.committed = True
+
+        # `filter_answer` strips, keep the whitespace before the next chunk
+        prefix = self.prefix.rstrip()
+        self.text = QAHandler.filter_answer(prefix) + self.prefix[len(prefix) :]
+        return self.text
 
 
 class QAHandler:
@@ -17,46 +121,609 @@ class QAHandler:
         self.pipelines = []
 
         self.response_history = []
+        self.race_history = deque(maxlen=self.race_history_size)
+
+        self.context_cache = ContextCache(self.context_cache_size)
+        self.context_registry = ContextRegistry(
+            self.context_cache, self.context_registry_size
+        )
+
+        self.answer_cache = AnswerCache(self.config)
 
         self.setup_pipelines()
 
+        self.semantic_cache = self.create_semantic_cache()
+
+        PROFILE.mark("qa_handler_ready")
+
+        if self.warm_up_enabled:
+            threading.Thread(target=self.warm_up, name="warm-up", daemon=True).start()
+
     def configure(self, config: dict):
-        self.config = config
+        self.config = config or {}
+
+        self.context_cache_size = self.config.get("context_cache_size", 32)
+        self.context_registry_size = self.config.get("context_registry_size", 1024)
+        self.race_history_size = self.config.get("race_history_size", 1000)
+        self.stream_min_prefix = self.config.get("stream_min_prefix", 80)
+        self.batch_max_parallel = self.config.get("batch_max_parallel", 4)
+
+        NLP.configure(self.config)
+        METRICS.configure(self.config)
+
+        # load models in the background instead of on the first question
+        self.warm_up_enabled = self.config.get("warm_up", False)
+
+    def warm_up(self) -> None:
+        for pipeline in self.pipelines:
+            try:
+                pipeline.warm_up()
+            except Exception as e:
+                logging.warning(f"Failed to warm up `{type(pipeline).__name__}`: {e}")
+
+        # models no pipeline here uses yet, e.g. for validation
+        try:
+            BasePipeline.get_models(self.config).preload(
+                self.config.get("preload_models", [])
+            )
+        except Exception as e:
+            logging.warning(f"Failed to preload models: {e}")
+
+        PROFILE.mark("warm_up_done")
+
+    def create_semantic_cache(self) -> SemanticAnswerCache:
+        if not self.config.get("semantic_cache", False):
+            return None
+
+        # share the cached embedder of the RAG pipeline
+        for pipeline in self.pipelines:
+            if isinstance(pipeline, RAGPipeline):
+                return SemanticAnswerCache(pipeline.cached_embedder, self.config)
+
+        logging.warning("Semantic cache needs a RAGPipeline for its embeddings")
+        return None
 
     def setup_pipelines(self):
+        if self.config.get("structured_pipeline", True):
+            self.pipelines.append(StructuredPipeline(dict(self.config)))
+
         self.pipelines.append(RAGPipeline(dict(self.config)))
 
         self.pipelines.append(Pipeline(dict(self.config)))
 
-    def answer(self, question: str, triple_data: dict) -> str:
-        context_data = ContextData.from_triples(triple_data)
-        context = str(context_data.to_compact_form())
+    def register_context(self, triple_data: dict, context_id: str = None) -> str:
+        return self.context_registry.put(triple_data, context_id)
+
+    def get_context(
+        self, triple_data: dict = None, context_id: str = None
+    ) -> CompactContext:
+        if context_id is not None:
+            return self.context_registry.get(context_id)
+
+        return self.context_cache.get(triple_data)
+
+    def answer(
+        self, question: str, triple_data: dict = None, context_id: str = None
+    ) -> str:
+        with trace("answer"):
+            compact_context = self.get_context(triple_data, context_id)
+            return self.answer_context(question, compact_context, context_id)
+
+    def answer_context(
+        self, question: str, compact_context: CompactContext, context_id: str = None
+    ) -> str:
+        context = compact_context.context
+
+        cache_lookup, cached_answer = self.get_cached_answer(question, compact_context)
+        if cached_answer is not None:
+            return self.finish_answer(cached_answer)
 
         query = {
             "input": question,
         }
 
         logging.info(f"Answering question: {question}")
-        for pipeline in self.pipelines:
-            pipeline.run(query, context=context)
+        start_time = time.perf_counter()
+        runs = []
+        try:
+            for pipeline in self.pipelines:
+                runs.append(
+                    pipeline.run(
+                        query,
+                        context=context,
+                        context_data=compact_context.compact_data,
+                        context_key=context_id,
+                    )
+                )
+
+                # the pipelines after an inline one only start if it cannot answer
+                if pipeline.inline and runs[-1].success:
+                    break
+        except Exception:
+            # e.g. `ExecutorBusyError`, nobody waits on the runs already started
+            for run in runs:
+                if run.is_running():
+                    run.cancel()
+            raise
 
+        # Pipelines are in priority order. Waiting on them in that order returns
+        # as soon as the highest priority pipeline that has not failed succeeds,
+        # whatever the pipelines after it are still doing.
         logging.info("Waiting for pipelines to finish...")
+        raw_response = ""
+        winner = None
+        for run in runs:
+            result = run.join()
+            if result.success:
+                raw_response = result.result
+                winner = run
+                break
+
+        self.record_race(runs, winner, time.perf_counter() - start_time)
+
+        return self.finish_answer(raw_response, cache_lookup if winner else None)
+
+    def answer_many(
+        self, items: Iterable[dict], max_parallel: int = None
+    ) -> List[BatchAnswer]:
+        return list(self.iter_answer_many(items, max_parallel))
+
+    def iter_answer_many(
+        self, items: Iterable[dict], max_parallel: int = None
+    ) -> Iterator[BatchAnswer]:
+        # Items are dicts with a `question` and a `context` or a `context_id`.
+        # Questions over the same context are answered together: the first one
+        # alone, so that the context is compacted and indexed once, then the
+        # others at once. Answers are yielded in the order of the items.
+        items = list(items)
+
+        groups = {}
+        for index, item in enumerate(items):
+            if item.get("context_id") is not None:
+                key = ("context_id", item["context_id"])
+            else:
+                key = ("context", fingerprint(item.get("context")))
+            groups.setdefault(key, []).append(index)
+
+        results = queue.Queue()
+
+        def answer_one(index: int, compact_context: CompactContext) -> None:
+            try:
+                with trace("answer"):
+                    answer = self.answer_context(
+                        items[index]["question"],
+                        compact_context,
+                        items[index].get("context_id"),
+                    )
+                results.put(BatchAnswer(index, answer=answer))
+            except Exception as e:
+                logging.error(f"Failed to answer item {index}: {e}")
+                results.put(BatchAnswer(index, error=str(e)))
+
+        def answer_group(indices: List[int]) -> None:
+            item = items[indices[0]]
+            try:
+                # parsed and compacted once for the group, traced on its own
+                with trace("context"):
+                    compact_context = self.get_context(
+                        item.get("context"), item.get("context_id")
+                    )
+            except UnknownContextError:
+                error = f"unknown context_id: {item.get('context_id')}"
+            except Exception as e:
+                error = f"invalid context: {e}"
+            else:
+                error = None
+
+            if error is not None:
+                for index in indices:
+                    results.put(BatchAnswer(index, error=error))
+                return
+
+            answer_one(indices[0], compact_context)
+            for index in indices[1:]:
+                executor.submit(answer_one, index, compact_context)
+
+        logging.info(f"Answering {len(items)} questions over {len(groups)} contexts")
+
+        executor = ThreadPoolExecutor(
+            max_workers=max_parallel or self.batch_max_parallel,
+            thread_name_prefix="answer-many",
+        )
+        try:
+            for indices in groups.values():
+                executor.submit(answer_group, indices)
+
+            # answered out of order, held back until the ones before are done
+            pending = {}
+            for next_index in range(len(items)):
+                while next_index not in pending:
+                    result = results.get()
+                    pending[result.index] = result
+                yield pending.pop(next_index)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    async def aanswer(
+        self, question: str, triple_data: dict = None, context_id: str = None
+    ) -> str:
+        with trace("answer"):
+            return await self._aanswer(question, triple_data, context_id)
+
+    async def _aanswer(
+        self, question: str, triple_data: dict = None, context_id: str = None
+    ) -> str:
+        compact_context = await asyncio.to_thread(
+            self.get_context, triple_data, context_id
+        )
+        context = compact_context.context
+
+        cache_lookup, cached_answer = await asyncio.to_thread(
+            self.get_cached_answer, question, compact_context
+        )
+        if cached_answer is not None:
+            return self.finish_answer(cached_answer)
+
+        query = {
+            "input": question,
+        }
+
+        logging.info(f"Answering question: {question}")
+        start_time = time.perf_counter()
+        tasks = []
         for pipeline in self.pipelines:
-            pipeline.join()
+            task = asyncio.create_task(
+                pipeline.arun(
+                    query,
+                    context=context,
+                    context_data=compact_context.compact_data,
+                    context_key=context_id,
+                )
+            )
+            tasks.append(task)
+
+            if pipeline.inline:
+                await asyncio.wait([task])
+                if task.exception() is None and task.result().success:
+                    break
 
+        # same priority order as `answer`, but losing pipelines are cancelled
         raw_response = ""
+        winner = None
+        try:
+            for pipeline, task in zip(self.pipelines, tasks):
+                try:
+                    result = await task
+                except Exception as e:
+                    logging.error(f"`{type(pipeline).__name__}` failed: {e}")
+                    continue
+
+                if result.success:
+                    raw_response = result.result
+                    winner = pipeline
+                    break
+        finally:
+            cancelled = [
+                type(pipeline).__name__
+                for pipeline, task in zip(self.pipelines, tasks)
+                if task.cancel()
+            ]
+
+        record = RaceRecord(
+            winner=type(winner).__name__ if winner is not None else None,
+            elapsed=time.perf_counter() - start_time,
+            cancelled=cancelled,
+            saved=0.0 if not cancelled else None,
+        )
+        self.add_race(record)
+
+        return self.finish_answer(raw_response, cache_lookup if winner else None)
+
+    def answer_stream(
+        self, question: str, triple_data: dict = None, context_id: str = None
+    ) -> Iterator[str]:
+        with trace("answer_stream"):
+            yield from self._answer_stream(question, triple_data, context_id)
+
+    def _answer_stream(
+        self, question: str, triple_data: dict = None, context_id: str = None
+    ) -> Iterator[str]:
+        compact_context = self.get_context(triple_data, context_id)
+        context = compact_context.context
+
+        cache_lookup, cached_answer = self.get_cached_answer(question, compact_context)
+        if cached_answer is not None:
+            yield self.finish_answer(cached_answer)
+            return
+
+        query = {
+            "input": question,
+        }
+
+        logging.info(f"Streaming answer to question: {question}")
+        start_time = time.perf_counter()
+        winner = None
+        gate = None
+        for pipeline in self.pipelines:
+            gate = StreamGate(pipeline, self.stream_min_prefix)
+            stream = None
+            try:
+                stream = pipeline.stream(
+                    query,
+                    context=context,
+                    context_data=compact_context.compact_data,
+                    context_key=context_id,
+                )
+                for chunk in stream:
+                    text = gate.feed(chunk)
+                    if text:
+                        yield text
+                    if gate.failed:
+                        break
+                text = gate.finish()
+                if text:
+                    yield text
+            except Exception as e:
+                logging.error(f"`{type(pipeline).__name__}` failed: {e}")
+                gate.error = e
+            finally:
+                if stream is not None:
+                    stream.close()
+
+            if not gate.failed and gate.error is None:
+                winner = gate
+                break
+
+            # the next pipeline cannot take back what was streamed
+            if gate.committed:
+                break
+
+        self.finish_stream(winner, time.perf_counter() - start_time, cache_lookup, gate)
+
+    async def aanswer_stream(
+        self, question: str, triple_data: dict = None, context_id: str = None
+    ) -> AsyncIterator[str]:
+        with trace("answer_stream"):
+            async for chunk in self._aanswer_stream(question, triple_data, context_id):
+                yield chunk
+
+    async def _aanswer_stream(
+        self, question: str, triple_data: dict = None, context_id: str = None
+    ) -> AsyncIterator[str]:
+        compact_context = await asyncio.to_thread(
+            self.get_context, triple_data, context_id
+        )
+        context = compact_context.context
+
+        cache_lookup, cached_answer = await asyncio.to_thread(
+            self.get_cached_answer, question, compact_context
+        )
+        if cached_answer is not None:
+            yield self.finish_answer(cached_answer)
+            return
+
+        query = {
+            "input": question,
+        }
+
+        logging.info(f"Streaming answer to question: {question}")
+        start_time = time.perf_counter()
+        winner = None
+        gate = None
         for pipeline in self.pipelines:
-            if pipeline.success:
-                raw_response = pipeline.result
+            gate = StreamGate(pipeline, self.stream_min_prefix)
+            stream = None
+            try:
+                stream = pipeline.astream(
+                    query,
+                    context=context,
+                    context_data=compact_context.compact_data,
+                    context_key=context_id,
+                )
+                async for chunk in stream:
+                    text = gate.feed(chunk)
+                    if text:
+                        yield text
+                    if gate.failed:
+                        break
+                text = gate.finish()
+                if text:
+                    yield text
+            except Exception as e:
+                logging.error(f"`{type(pipeline).__name__}` failed: {e}")
+                gate.error = e
+            finally:
+                if stream is not None:
+                    await stream.aclose()
+
+            if not gate.failed and gate.error is None:
+                winner = gate
                 break
 
+            # the next pipeline cannot take back what was streamed
+            if gate.committed:
+                break
+
+        self.finish_stream(winner, time.perf_counter() - start_time, cache_lookup, gate)
+
+    def finish_stream(
+        self,
+        winner: StreamGate,
+        elapsed: float,
+        cache_lookup: CacheLookup = None,
+        last: StreamGate = None,
+    ) -> None:
+        # `last` is the gate of the last pipeline streamed, `winner` too if set
+        interrupted = None
+        if last is not None and last.committed and last.error is not None:
+            interrupted = type(last.pipeline).__name__
+
+        record = RaceRecord(
+            winner=type(winner.pipeline).__name__ if winner is not None else None,
+            elapsed=elapsed,
+            interrupted=interrupted,
+            saved=0.0,
+        )
+        self.add_race(record)
+
+        self.response_history.append(winner.text if winner is not None else "")
+        PROFILE.mark("first_answer")
+
+        if winner is not None and cache_lookup is not None:
+            self.cache_answer(cache_lookup, winner.text)
+
+    @measure_time(name="cache_lookup")
+    def get_cached_answer(
+        self, question: str, compact_context: CompactContext
+    ) -> Tuple[CacheLookup, str]:
+        # exact match first, then questions with a similar embedding over the
+        # same context and pipeline configuration
+        scope = self.answer_cache.make_key(
+            "", compact_context.context_fingerprint, self.pipelines
+        )
+        cache_lookup = CacheLookup(
+            key=self.answer_cache.make_key(
+                question, compact_context.context_fingerprint, self.pipelines
+            ),
+            scope=scope,
+        )
+
+        cached_answer = self.answer_cache.get(cache_lookup.key)
+        if cached_answer is not None:
+            logging.info(f"Answer cache hit for question: {question}")
+            annotate(cache="exact")
+            return cache_lookup, cached_answer
+
+        if self.semantic_cache is not None:
+            cache_lookup.vector = self.semantic_cache.embed(
+                AnswerCache.normalize_question(question)
+            )
+            cache_lookup.entities = self.semantic_cache.get_entities(
+                question, compact_context.compact_data
+            )
+            cached_answer = self.semantic_cache.get(
+                scope, cache_lookup.vector, cache_lookup.entities
+            )
+            if cached_answer is not None:
+                logging.info(f"Semantic cache hit for question: {question}")
+                annotate(cache="semantic")
+
+        return cache_lookup, cached_answer
+
+    def cache_answer(self, cache_lookup: CacheLookup, answer: str) -> None:
+        self.answer_cache.put(cache_lookup.key, answer)
+
+        if self.semantic_cache is not None and cache_lookup.vector is not None:
+            self.semantic_cache.put(
+                cache_lookup.scope, cache_lookup.vector, answer, cache_lookup.entities
+            )
+
+    def finish_answer(self, raw_response: str, cache_lookup: CacheLookup = None) -> str:
         response = self.filter_answer(raw_response)
 
         self.response_history.append(response)
+        PROFILE.mark("first_answer")
+
+        if cache_lookup is not None:
+            self.cache_answer(cache_lookup, response)
 
         return response
 
+    def record_race(
+        self, runs: List[PipelineRun], winner: PipelineRun, elapsed: float
+    ) -> RaceRecord:
+        # Runs still queued on the executor are cancelled, runs already started
+        # cannot be interrupted and are abandoned, their result is ignored.
+        cancelled = []
+        abandoned = []
+        for run in runs:
+            if run is winner or not run.is_running():
+                continue
+            (cancelled if run.cancel() else abandoned).append(run)
+
+        record = RaceRecord(
+            winner=type(winner.pipeline).__name__ if winner is not None else None,
+            elapsed=elapsed,
+            abandoned=[type(run.pipeline).__name__ for run in abandoned],
+            cancelled=[type(run.pipeline).__name__ for run in cancelled],
+        )
+        self.add_race(record)
+
+        if not abandoned:
+            record.saved = 0.0
+            return record
+
+        answer_time = time.perf_counter()
+        pending = set(abandoned)
+        lock = threading.Lock()
+
+        def on_done(run: PipelineRun) -> None:
+            with lock:
+                pending.discard(run)
+                if not pending:
+                    record.saved = time.perf_counter() - answer_time
+
+        for run in abandoned:
+            run.add_done_callback(on_done)
+
+        return record
+
+    def stats(self) -> dict:
+        return {
+            "answer_cache": self.answer_cache.stats(),
+            "context_cache": self.context_cache.stats(),
+            "semantic_cache": (
+                self.semantic_cache.stats() if self.semantic_cache is not None else None
+            ),
+            "races": self.race_stats(),
+            "models": BasePipeline.get_models(self.config).stats(),
+            "generation": {
+                name: coalescer.stats()
+                for name, coalescer in BasePipeline.coalescers.items()
+            },
+            "startup": PROFILE.report(),
+        }
+
+    def metrics(self) -> dict:
+        return METRICS.report()
+
+    def add_race(self, record: RaceRecord) -> None:
+        self.race_history.append(record)
+        self.log_race(record)
+
+        annotate(winner=record.winner)
+
+    @staticmethod
+    def log_race(record: RaceRecord) -> None:
+        logging.info(
+            f"Race won by `{record.winner}` in {record.elapsed:.3f} seconds, "
+            f"abandoned: {record.abandoned}, cancelled: {record.cancelled}, "
+            f"interrupted: {record.interrupted}"
+        )
+
+    def race_stats(self) -> dict:
+        records = list(self.race_history)
+        saved = [x.saved for x in records if x.saved is not None]
+
+        wins = {}
+        for record in records:
+            wins[record.winner] = wins.get(record.winner, 0) + 1
+
+        return {
+            "races": len(records),
+            "wins": wins,
+            "abandoned": sum(len(x.abandoned) for x in records),
+            "cancelled": sum(len(x.cancelled) for x in records),
+            "interrupted": sum(x.interrupted is not None for x in records),
+            "mean_elapsed": (
+                sum(x.elapsed for x in records) / len(records) if records else 0.0
+            ),
+            "total_saved": sum(saved),
+            "mean_saved": sum(saved) / len(saved) if saved else 0.0,
+        }
+
     @staticmethod
+    @measure_time(name="filtering")
     def filter_answer(raw_answer: str) -> str:
 
         if not "context" in raw_answer:
@@ -0,0 +1,285 @@
+import logging
+import math
+import re
+import threading
+import weakref
+from collections import defaultdict
+from typing import Any, Dict, List, Tuple
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from context import ContextData, make_id, tokenize
+from nlp import NLP
+from triple_store import TripleStore
+
+
+class GraphRetriever:
+    # Selects the triples around the entities a question mentions instead of
+    # the whole context: the neighborhood of the matched terms is walked for up
+    # to `hops` steps, nearest triples first, as long as they fit the token
+    # budget. Only named entities and proper nouns of the question are matched,
+    # not common words that happen to be terms, e.g. "fall".
+    def __init__(self, config: dict = None) -> None:
+        self.configure(config or {})
+
+        # lowercase names per store, built on first use
+        self.names = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    def configure(self, config: dict) -> None:
+        self.config = config
+
+        self.hops = config.get("graph_hops", 2)
+        self.token_budget = config.get("graph_token_budget", 512)
+        self.max_name_words = config.get("graph_max_name_words", 4)
+
+    @staticmethod
+    def count_tokens(text: str) -> int:
+        # about four characters per token for English text and the triple syntax
+        return len(text) // 4 + 1
+
+    def get_names(self, store: TripleStore) -> Dict[str, int]:
+        with self.lock:
+            names = self.names.get(store)
+            if names is not None:
+                return names
+
+        names = {}
+        for term_id in store.subject_index.unique() + store.object_index.unique():
+            name = " ".join(tokenize(str(store.terms[term_id])))
+            if name and not name.isdigit():
+                names.setdefault(name, term_id)
+
+        with self.lock:
+            self.names[store] = names
+
+        return names
+
+    def find_entities(self, question: str, store: TripleStore) -> List[int]:
+        names = self.get_names(store)
+
+        # the same parse as `StructuredPipeline`, cached by `NLP`
+        analysis = NLP.analyse([question])[0]
+        candidates = [" ".join(tokenize(text)) for text, _ in analysis.entities]
+
+        # every run of up to `max_name_words` proper nouns, for names the
+        # entity recognizer misses
+        runs = [[]]
+        for text, pos in analysis.pos_tags:
+            if pos == "PROPN":
+                runs[-1] += tokenize(text)
+            elif runs[-1]:
+                runs.append([])
+
+        for tokens in runs:
+            for size in range(1, self.max_name_words + 1):
+                for start in range(len(tokens) - size + 1):
+                    candidates.append(" ".join(tokens[start : start + size]))
+
+        term_ids = []
+        for candidate in candidates:
+            term_id = names.get(candidate)
+            if term_id is not None and term_id not in term_ids:
+                term_ids.append(term_id)
+
+        return term_ids
+
+    def retrieve(self, question: str, context_data: ContextData) -> List[List[str]]:
+        store = context_data.store
+
+        frontier = self.find_entities(question, store)
+        if not frontier:
+            return []
+
+        visited = set(frontier)
+        selected = set()
+        seen = set()
+        tokens = 0
+
+        for _ in range(self.hops):
+            next_frontier = []
+            for term_id in frontier:
+                rows = store.subject_index.lookup(term_id)
+                rows += store.object_index.lookup(term_id)
+
+                for row in rows:
+                    # repeated triples would only take up the budget
+                    ids = store.get_ids(row)
+                    if ids in seen:
+                        continue
+                    seen.add(ids)
+
+                    # too large for what is left, a shorter one may still fit
+                    cost = self.count_tokens(str(store.get_triple(row)))
+                    if tokens + cost > self.token_budget:
+                        continue
+
+                    selected.add(row)
+                    tokens += cost
+                    if tokens >= self.token_budget:
+                        return self.finish(store, selected, tokens)
+
+                    subject_id, _, object_id = ids
+                    for neighbor_id in (subject_id, object_id):
+                        if neighbor_id not in visited:
+                            visited.add(neighbor_id)
+                            next_frontier.append(neighbor_id)
+
+            frontier = next_frontier
+
+        return self.finish(store, selected, tokens)
+
+    def finish(self, store: TripleStore, selected: set, tokens: int) -> List[List[str]]:
+        logging.debug(
+            f"Retrieved {len(selected)} of {len(store)} triples (~{tokens} tokens)"
+        )
+        return [store.get_triple(row) for row in sorted(selected)]
+
+
+class BM25Index:
+    # Okapi BM25 over short documents, one per compacted triple. Documents are
+    # added and removed in place and the collection statistics are running
+    # totals, so a changed context only costs its changed lines. Contexts that
+    # share the index are searched with their lines, see `search`.
+    def __init__(self, k1: float = 1.5, b: float = 0.75) -> None:
+        self.k1 = k1
+        self.b = b
+
+        self.documents = {}
+        self.lengths = {}
+        self.postings = defaultdict(dict)
+        self.total_length = 0
+
+        # of the lines indexed, see `make_key`
+        self.key = None
+
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    @staticmethod
+    def tokenize(text: str) -> List[str]:
+        # the parts of camel case words as well, e.g. `hasFavoriteFood`
+        tokens = []
+        for word in re.findall(r"[A-Za-z0-9]+", text):
+            parts = re.findall(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|[0-9]+", word)
+            tokens += [part.lower() for part in parts]
+            if len(parts) > 1:
+                tokens.append(word.lower())
+        return tokens
+
+    @staticmethod
+    def make_key(texts: List[str]) -> str:
+        return make_id("\n".join(texts))
+
+    def add(self, text: str) -> None:
+        doc_id = make_id(text)
+        if doc_id in self.documents:
+            return
+
+        tokens = self.tokenize(text)
+        for token in tokens:
+            self.postings[token][doc_id] = self.postings[token].get(doc_id, 0) + 1
+
+        self.documents[doc_id] = text
+        self.lengths[doc_id] = len(tokens)
+        self.total_length += len(tokens)
+
+    def remove(self, doc_id: str) -> None:
+        text = self.documents.pop(doc_id)
+        self.total_length -= self.lengths.pop(doc_id)
+
+        for token in set(self.tokenize(text)):
+            postings = self.postings[token]
+            postings.pop(doc_id, None)
+            if not postings:
+                del self.postings[token]
+
+    def update(self, texts: List[str]) -> "BM25Index":
+        with self.lock:
+            self.apply(texts, self.make_key(texts))
+        return self
+
+    def apply(self, texts: List[str], key: str) -> None:
+        # with the lock held
+        ids = {make_id(text): text for text in texts}
+
+        removed = [doc_id for doc_id in self.documents if doc_id not in ids]
+        for doc_id in removed:
+            self.remove(doc_id)
+
+        added = [text for doc_id, text in ids.items() if doc_id not in self.documents]
+        for text in added:
+            self.add(text)
+
+        self.key = key
+
+        logging.debug(f"BM25 index: {len(added)} added, {len(removed)} removed")
+
+    def search(
+        self, query: str, k: int = 4, texts: List[str] = None, key: str = None
+    ) -> List[Tuple[str, float]]:
+        with self.lock:
+            # another context was indexed since `texts`, back to them first
+            if texts is not None and key != self.key:
+                self.apply(texts, key)
+
+            count = len(self.documents)
+            if count == 0:
+                return []
+
+            average_length = self.total_length / count
+
+            scores = defaultdict(float)
+            for token in set(self.tokenize(query)):
+                postings = self.postings.get(token)
+                if not postings:
+                    continue
+
+                idf = math.log(
+                    1 + (count - len(postings) + 0.5) / (len(postings) + 0.5)
+                )
+                for doc_id, frequency in postings.items():
+                    norm = 1 - self.b + self.b * self.lengths[doc_id] / average_length
+                    scores[doc_id] += (
+                        idf * frequency * (self.k1 + 1) / (frequency + self.k1 * norm)
+                    )
+
+            ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)[:k]
+            return [(self.documents[doc_id], score) for doc_id, score in ranked]
+
+
+class HybridRetriever(BaseRetriever):
+    # BM25 and, unless lexical only, a vector store retriever, combined by
+    # reciprocal rank fusion. Both rank single triples, so equal texts add up.
+    lexical: BM25Index
+    vector: Any = None
+    k: int = 16
+    rrf_k: int = 60
+
+    # the lines of the context, if the lexical index is shared with others
+    texts: List[str] = None
+    key: str = None
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        lexical = self.lexical.search(query, self.k, self.texts, self.key)
+        rankings = [[text for text, _ in lexical]]
+
+        if self.vector is not None:
+            documents = self.vector.invoke(
+                query, config={"callbacks": run_manager.get_child()}
+            )
+            rankings.append([document.page_content for document in documents])
+
+        scores = defaultdict(float)
+        for ranking in rankings:
+            for rank, text in enumerate(ranking):
+                scores[text] += 1 / (self.rrf_k + rank + 1)
+
+        ranked = sorted(scores, key=scores.get, reverse=True)[: self.k]
+        return [Document(page_content=text) for text in ranked]
@@ -1,10 +1,14 @@
 import json
 import logging
 import logging.config
+from typing import Any, Iterator, List
 
-from flask import Flask, request as Request
+from flask import Flask, Response, request as Request, stream_with_context
 
-from qa import QAHandler
+from executor import ExecutorBusyError
+from context import UnknownContextError
+from qa import BatchAnswer, QAHandler
+from startup import PROFILE
 
 
 class QAService:
@@ -12,7 +16,7 @@ class QAService:
     def __init__(self, config: dict):
         self.configure(config)
 
-        self.server = Flask(__name__)
+        self.server = self.create_server()
 
         self.setup_routes()
         self.setup_qa_handler()
@@ -22,6 +26,9 @@ class QAService:
 
         self.port = config.get("port", 9880)
 
+    def create_server(self) -> Flask:
+        return Flask(__name__)
+
     def setup_qa_handler(self):
         self.qa_handler = QAHandler(self.config)
 
@@ -32,17 +39,179 @@ class QAService:
             logging.info(f"Received request: {request}")
 
             question = request["question"]
-            context = request["context"]
-
-            answer = self.qa_handler.answer(question, context)
+            context = request.get("context")
+            context_id = request.get("context_id")
+
+            if request.get("stream", False):
+                try:
+                    self.qa_handler.get_context(context, context_id)
+                except UnknownContextError:
+                    return self.unknown_context(context_id)
+
+                events = self.stream_events(
+                    self.qa_handler.answer_stream(question, context, context_id)
+                )
+                return Response(
+                    stream_with_context(events), mimetype="text/event-stream"
+                )
+
+            try:
+                answer = self.qa_handler.answer(question, context, context_id)
+            except UnknownContextError:
+                return self.unknown_context(context_id)
+            except ExecutorBusyError as e:
+                logging.warning(f"Rejected request: {e}")
+                return json.dumps({"error": "server busy"}), 503
 
             response = {
                 "answer": answer,
             }
             return json.dumps(response)
 
+        @self.server.route("/kb/qa/batch", methods=["POST"])
+        def answer_batch() -> str:
+            request = Request.get_json()
+            items = self.batch_items(request)
+            logging.info(f"Received batch of {len(items)} questions")
+
+            # one line of JSON per answer as it is ready, in order
+            if request.get("stream", False):
+                lines = self.batch_lines(self.qa_handler.iter_answer_many(items))
+                return Response(
+                    stream_with_context(lines), mimetype="application/x-ndjson"
+                )
+
+            answers = self.qa_handler.answer_many(items)
+
+            response = {
+                "answers": [self.format_batch_answer(x) for x in answers],
+            }
+            return json.dumps(response)
+
+        @self.server.route("/kb/stats", methods=["GET"])
+        def stats() -> str:
+            return json.dumps(self.qa_handler.stats())
+
+        @self.server.route("/metrics", methods=["GET"])
+        def metrics() -> str:
+            return json.dumps(self.qa_handler.metrics())
+
+        @self.server.route("/kb/context", methods=["POST"])
+        def create_context() -> str:
+            return self.create_context(Request.get_json())
+
+        @self.server.route("/kb/context/<context_id>", methods=["PUT"])
+        def update_context(context_id: str) -> str:
+            return self.update_context(context_id, Request.get_json(), Request.if_match)
+
+        @self.server.route("/kb/context/<context_id>", methods=["GET"])
+        def get_context(context_id: str) -> str:
+            return self.get_context(context_id, Request.if_none_match)
+
+        @self.server.route("/kb/context/<context_id>", methods=["DELETE"])
+        def delete_context(context_id: str) -> str:
+            return self.delete_context(context_id)
+
+    @staticmethod
+    def batch_items(request: dict) -> List[dict]:
+        # questions are strings or dicts, the context of the batch is the
+        # default for the questions without one of their own
+        items = []
+        for item in request["questions"]:
+            item = {"question": item} if type(item) is str else dict(item)
+            if "context" not in item and "context_id" not in item:
+                item["context"] = request.get("context")
+                item["context_id"] = request.get("context_id")
+            items.append(item)
+        return items
+
+    @staticmethod
+    def format_batch_answer(result: BatchAnswer) -> dict:
+        if result.error is not None:
+            return {"index": result.index, "error": result.error}
+        return {"index": result.index, "answer": result.answer}
+
+    def batch_lines(self, answers: Iterator[BatchAnswer]) -> Iterator[str]:
+        try:
+            for answer in answers:
+                yield json.dumps(self.format_batch_answer(answer)) + "\n"
+        finally:
+            # e.g. the client went away, the questions not started are dropped
+            answers.close()
+
+    def stream_events(self, chunks: Iterator[str]) -> Iterator[str]:
+        answer = ""
+        for chunk in chunks:
+            answer += chunk
+            yield self.format_event({"token": chunk})
+
+        yield self.format_event({"answer": answer}, event="end")
+
+    @staticmethod
+    def format_event(data: dict, event: str = None) -> str:
+        # server-sent event, data is JSON so that newlines in tokens are kept
+        output = f"event: {event}\n" if event else ""
+        output += f"data: {json.dumps(data)}\n\n"
+        return output
+
+    def create_context(self, request: dict) -> tuple:
+        context_id = self.qa_handler.register_context(request["context"])
+        logging.info(f"Registered context: {context_id}")
+
+        return self.context_response(context_id, status=201)
+
+    def update_context(self, context_id: str, request: dict, if_match: Any) -> tuple:
+        if if_match:
+            try:
+                context = self.qa_handler.get_context(context_id=context_id)
+                version = context.fingerprint
+            except UnknownContextError:
+                version = None
+
+            if version is None or version not in if_match:
+                return json.dumps({"error": "version mismatch"}), 412
+
+        self.qa_handler.register_context(request["context"], context_id)
+        logging.info(f"Updated context: {context_id}")
+
+        return self.context_response(context_id)
+
+    def get_context(self, context_id: str, if_none_match: Any) -> tuple:
+        try:
+            context = self.qa_handler.get_context(context_id=context_id)
+        except UnknownContextError:
+            return self.unknown_context(context_id)
+
+        if context.fingerprint in if_none_match:
+            return "", 304, {"ETag": f'"{context.fingerprint}"'}
+
+        return self.context_response(context_id)
+
+    def delete_context(self, context_id: str) -> tuple:
+        if not self.qa_handler.context_registry.delete(context_id):
+            return self.unknown_context(context_id)
+
+        return "", 204
+
+    def context_response(self, context_id: str, status: int = 200) -> tuple:
+        version = self.qa_handler.get_context(context_id=context_id).fingerprint
+
+        response = {
+            "context_id": context_id,
+            "version": version,
+        }
+        return json.dumps(response), status, {"ETag": f'"{version}"'}
+
+    @staticmethod
+    def unknown_context(context_id: str) -> tuple:
+        response = {
+            "error": f"unknown context_id: {context_id}",
+        }
+        return json.dumps(response), 404
+
     def run(self, port: int = None):
         port = port or self.port
+        PROFILE.mark("server_ready")
         logging.info(f"Starting QA service on port {port}")
         self.server.run(host="0.0.0.0", port=port, debug=False)
 
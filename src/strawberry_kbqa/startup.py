@@ -0,0 +1,122 @@
+import argparse
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+
+def get_process_age() -> float:
+    # seconds since the process started, from /proc on Linux
+    try:
+        with open("/proc/self/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class StartupProfile:
+    # Seconds from the start of the process, or from the import of this module
+    # where that is unknown, to named points of the startup. Only the first
+    # mark of a name counts.
+    def __init__(self) -> None:
+        self.start_time = time.perf_counter() - (get_process_age() or 0.0)
+        self.marks = {}
+        self.lock = threading.Lock()
+
+    def mark(self, name: str) -> None:
+        if name in self.marks:
+            return
+
+        with self.lock:
+            if name not in self.marks:
+                self.marks[name] = time.perf_counter() - self.start_time
+                logging.info(f"Startup: `{name}` after {self.marks[name]:.3f}s")
+
+    def report(self) -> Dict[str, float]:
+        return dict(self.marks)
+
+
+PROFILE = StartupProfile()
+
+
+def measure_imports(module: str, top: int = 15) -> List[dict]:
+    # `-X importtime` in a fresh interpreter, so nothing is imported already
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.abspath(os.path.dirname(__file__)),
+        capture_output=True,
+        text=True,
+    ).stderr
+
+    cumulative = {}
+    for line in output.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \|\s*(\S+)", line)
+        if match is None:
+            continue
+
+        # top level packages and modules, submodules add up in their package
+        name = match.group(2)
+        if "." not in name:
+            cumulative[name] = max(cumulative.get(name, 0), int(match.group(1)))
+
+    ranked = sorted(cumulative.items(), key=lambda x: x[1], reverse=True)[:top]
+    return [{"module": name, "seconds": us / 1e6} for name, us in ranked]
+
+
+def profile(config: dict, question: str, triples: dict) -> dict:
+    start_time = time.perf_counter()
+    from qa import QAHandler
+
+    import_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    qa_handler = QAHandler(config)
+    init_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    qa_handler.answer(question, triples)
+    first_answer_seconds = time.perf_counter() - start_time
+
+    return {
+        "import_seconds": import_seconds,
+        "init_seconds": init_seconds,
+        "first_answer_seconds": first_answer_seconds,
+        "marks": PROFILE.report(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Import time per module and time to the first answer."
+    )
+    parser.add_argument("--module", default="server")
+    parser.add_argument("--question", default="How old is Timmy?")
+    parser.add_argument(
+        "--triples",
+        default=os.path.join(
+            os.path.dirname(__file__), "..", "..", "data", "triples.json"
+        ),
+    )
+    parser.add_argument("--warm-up", action="store_true")
+    parser.add_argument("--no-answer", action="store_true")
+    args = parser.parse_args()
+
+    report = {"imports": measure_imports(args.module)}
+
+    if not args.no_answer:
+        from context import load_triples
+
+        triples = load_triples(args.triples)
+        report.update(profile({"warm_up": args.warm_up}, args.question, triples))
+
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,337 @@
+import asyncio
+import logging
+import re
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, Iterator, List
+
+from context import ContextData, tokenize
+from nlp import NLP
+from pipeline import BasePipeline, PipelineResult, PipelineRun
+from timer import Timer
+
+
+@dataclass
+class SubjectIndex:
+    # by lowercase subject, and by its words for names within a question
+    subjects: Dict[str, str]
+    names: Dict[str, str]
+    max_words: int
+    # of the store when indexed, a store that grew is indexed again
+    size: int
+
+
+class StructuredPipeline(BasePipeline):
+    # Answers direct attribute questions, e.g. "How old is Timmy?", from one
+    # (subject, predicate) lookup in the compacted context and a templated
+    # sentence, without an LLM. Questions it cannot map to exactly one lookup
+    # fail, so that the pipelines after it answer them.
+
+    # run in the caller, the pipelines after it are only started if it fails
+    inline = True
+
+    default_model_name = "structured"
+    default_prompt_template = "{possessive} {attribute} {be} {value}."
+
+    # templates for predicates that do not read well as "<subject>'s <words>"
+    answer_templates = {
+        "hasAge": "{subject} {be} {value} years old.",
+        "hasHometown": "{subject} {be} from {value}.",
+        "hasProfession": "{subject} {be} a {value}.",
+    }
+
+    # question words naming a predicate other than the words of the predicate
+    predicate_synonyms = {
+        "hasAge": {"old", "age"},
+        "hasHometown": {"from", "hometown"},
+        "hasProfession": {"job", "profession", "work", "occupation"},
+    }
+
+    question_words = {"what", "who", "where", "which", "how"}
+    self_words = {"you", "your", "yourself"}
+
+    # words a direct attribute question may have besides the question word,
+    # the subject and the predicate
+    filler_words = {"is", "are", "am", "do", "does", "the", "a", "an", "of", "for"}
+    filler_words |= {"have", "has"}
+
+    # negations, other times than now, and units: the stored value is not the
+    # answer as it is
+    qualifier_words = {"not", "no", "never", "t", "without", "except"}
+    qualifier_words |= {"was", "were", "did", "had", "been", "be", "will", "would"}
+    qualifier_words |= {"can", "could", "should", "may", "might", "ago", "before"}
+    qualifier_words |= {"after", "since", "until", "next", "last", "ever"}
+    qualifier_words |= {"year", "month", "week", "day", "hour", "minute"}
+    number_words = {"one", "two", "three", "four", "five", "six", "seven"}
+    number_words |= {"eight", "nine", "ten", "twice", "half", "dozen"}
+
+    def __init__(self, config: dict = None) -> None:
+        config = config or self.get_default_config()
+
+        # no model to load, only the lookups below
+        self.configure(config)
+
+        # per store, built on first use, see `get_subject_index`
+        self.subject_indexes = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    def configure(self, config: dict) -> None:
+        if "model_name" not in config:
+            config["model_name"] = StructuredPipeline.default_model_name
+
+        if "prompt_template" not in config:
+            config["prompt_template"] = StructuredPipeline.default_prompt_template
+
+        # who "you" refers to in questions
+        self.self_name = config.get("structured_self_name", "Haru")
+
+        return super().configure(config)
+
+    @classmethod
+    def get_default_config(self) -> dict:
+        return {
+            "model_name": StructuredPipeline.default_model_name,
+            "prompt_template": StructuredPipeline.default_prompt_template,
+        }
+
+    def warm_up(self) -> None:
+        NLP.load()
+
+    @staticmethod
+    def singular(word: str) -> str:
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            return word[:-1]
+        return word
+
+    @staticmethod
+    def predicate_words(predicate: str) -> List[str]:
+        words = re.findall(r"[A-Z]?[a-z]+|[0-9]+", predicate)
+        words = [word.lower() for word in words]
+        return words[1:] if words and words[0] in ("has", "is") else words
+
+    def get_subject_index(self, context_data: ContextData) -> SubjectIndex:
+        store = context_data.store
+        with self.lock:
+            index = self.subject_indexes.get(store)
+        if index is not None and index.size == len(store):
+            return index
+
+        subjects = {
+            subject.lower(): subject for subject in context_data.get_unique_subjects()
+        }
+        names = {}
+        for subject in subjects.values():
+            name = " ".join(tokenize(subject))
+            if name:
+                names.setdefault(name, subject)
+
+        index = SubjectIndex(
+            subjects=subjects,
+            names=names,
+            max_words=max((len(x.split()) for x in names), default=0),
+            size=len(store),
+        )
+        with self.lock:
+            self.subject_indexes[store] = index
+
+        return index
+
+    def find_subject(self, question: str, context_data: ContextData) -> str:
+        index = self.get_subject_index(context_data)
+        subjects = index.subjects
+
+        analysis = NLP.analyse([question])[0]
+        candidates = [text for text, _ in analysis.entities]
+        candidates += analysis.subjects + analysis.objects
+
+        found = set()
+        for candidate in candidates:
+            candidate = re.sub(r"['’]s$", "", candidate.strip()).lower()
+            if candidate in subjects:
+                found.add(subjects[candidate])
+
+        # names the parser did not pick up, e.g. lowercase ones: every run of
+        # words of the question up to the longest name
+        tokens = tokenize(question)
+        for size in range(1, index.max_words + 1):
+            for start in range(len(tokens) - size + 1):
+                subject = index.names.get(" ".join(tokens[start : start + size]))
+                if subject is not None:
+                    found.add(subject)
+
+        if self.self_words.intersection(tokenize(question)):
+            found.add(subjects.get(self.self_name.lower(), self.self_name))
+
+        return found.pop() if len(found) == 1 else None
+
+    def find_predicate(
+        self, question: str, subject: str, context_data: ContextData
+    ) -> str:
+        subject_words = set(tokenize(subject))
+        tokens = [x for x in tokenize(question) if x not in subject_words]
+        words = {self.singular(x) for x in tokens}
+
+        matches = {}
+        for context in context_data.get_all_with_subject(subject):
+            predicate = context[1]
+            predicate_words = {
+                self.singular(x) for x in self.predicate_words(predicate)
+            }
+
+            if predicate_words and predicate_words <= words:
+                matches[predicate] = predicate_words
+            elif self.predicate_synonyms.get(predicate, set()).intersection(tokens):
+                matches[predicate] = predicate_words
+
+        # "favorite food" wins over "favorite", anything else is ambiguous
+        matches = [
+            predicate
+            for predicate, predicate_words in matches.items()
+            if not any(predicate_words < other for other in matches.values())
+        ]
+
+        return matches[0] if len(matches) == 1 else None
+
+    def is_direct(self, question: str, subject: str, predicate: str) -> bool:
+        # Only a question about the predicate of the subject and nothing else,
+        # e.g. not "How old was Timmy two years ago?" or "What is the name of
+        # Timmy's cat?". Those are left to the pipelines after this one.
+        if re.search(r"[0-9]", question):
+            return False
+
+        words = {self.singular(x) for x in tokenize(question)}
+        if words & (self.qualifier_words | self.number_words):
+            return False
+
+        known = self.question_words | self.self_words | self.filler_words
+        known |= set(tokenize(subject))
+        known |= {self.singular(x) for x in self.predicate_words(predicate)}
+        known |= self.predicate_synonyms.get(predicate, set())
+
+        return words <= known | {self.singular(x) for x in known}
+
+    def render(self, subject: str, predicate: str, values: List[str]) -> str:
+        is_self = subject == self.self_name
+        plural = len(values) > 1
+
+        be = "are" if plural else "is"
+        if is_self and predicate in self.answer_templates:
+            be = "am"
+
+        attribute = " ".join(self.predicate_words(predicate))
+        if plural:
+            attribute += "s"
+
+        value = values[-1]
+        if plural:
+            value = f"{', '.join(values[:-1])} and {values[-1]}"
+
+        template = self.answer_templates.get(predicate, self.prompt_template)
+        answer = template.format(
+            subject="I" if is_self else subject,
+            possessive="My" if is_self else f"{subject}'s",
+            attribute=attribute,
+            be=be,
+            value=value,
+        )
+
+        return answer[0].upper() + answer[1:]
+
+    def lookup(self, question: str, context_data: ContextData) -> str:
+        tokens = tokenize(question)
+        if not tokens or tokens[0] not in self.question_words:
+            return ""
+
+        # counting questions need more than one triple
+        if tokens[:2] == ["how", "many"]:
+            return ""
+
+        if context_data is None or len(context_data) == 0:
+            return ""
+
+        subject = self.find_subject(question, context_data)
+        if subject is None:
+            return ""
+
+        predicate = self.find_predicate(question, subject, context_data)
+        if predicate is None or not self.is_direct(question, subject, predicate):
+            return ""
+
+        values = [
+            context[2]
+            for context in context_data.get_all_with_subject_predicate(
+                subject, predicate
+            )
+        ]
+        if not values:
+            return ""
+
+        logging.debug(f"Structured lookup: ({subject}, {predicate}) -> {values}")
+
+        return self.render(subject, predicate, values)
+
+    def invoke(self, query: dict, context_data: ContextData) -> PipelineResult:
+        start_time = time.perf_counter()
+
+        with Timer("retrieval", mode="structured"):
+            raw_result = self.lookup(query["input"], context_data)
+
+        return PipelineResult(
+            raw_result=raw_result,
+            success=not self.has_failed(raw_result),
+            elapsed=time.perf_counter() - start_time,
+        )
+
+    def run(
+        self,
+        query: dict,
+        context: str = None,
+        context_data: ContextData = None,
+        **kwargs,
+    ) -> PipelineRun:
+        # a lookup takes milliseconds, queueing it behind the LLM calls on the
+        # executor would only delay it
+        future = Future()
+        try:
+            future.set_result(self.invoke(query, context_data))
+        except Exception as e:
+            future.set_exception(e)
+
+        return PipelineRun(self, future)
+
+    async def arun(
+        self,
+        query: dict,
+        context: str = None,
+        context_data: ContextData = None,
+        **kwargs,
+    ) -> PipelineResult:
+        return await asyncio.to_thread(self.invoke, query, context_data)
+
+    def stream(
+        self,
+        query: dict,
+        context: str = None,
+        context_data: ContextData = None,
+        **kwargs,
+    ) -> Iterator[str]:
+        result = self.invoke(query, context_data)
+        if result.success:
+            yield result.result
+
+    async def astream(
+        self,
+        query: dict,
+        context: str = None,
+        context_data: ContextData = None,
+        **kwargs,
+    ) -> AsyncIterator[str]:
+        result = await self.arun(query, context_data=context_data)
+        if result.success:
+            yield result.result
+
+    def has_failed(self, raw_result: str) -> bool:
+        return not raw_result
@@ -1,27 +1,235 @@
+import contextvars
+import functools
+import json
+import logging
+import threading
 import time
+import uuid
+from collections import deque
+from typing import Callable, Dict, List
+
+# the trace of the request being answered, see `trace`
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Histogram:
+    # Count, mean and max of every sample, percentiles over the last `size`.
+    def __init__(self, size: int = 1000) -> None:
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, samples: List[float], q: float) -> float:
+        # nearest rank
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def report(self) -> dict:
+        samples = sorted(self.samples)
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(samples, 0.50),
+            "p95": self.percentile(samples, 0.95),
+            "p99": self.percentile(samples, 0.99),
+            "max": self.max,
+        }
+
+
+class Trace:
+    # The spans of one request. Stages that run several times in a request,
+    # e.g. generation in every pipeline, add up in its histograms.
+    def __init__(self, name: str, **attributes) -> None:
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.attributes = attributes
+
+        self.wall_time = time.time()
+        self.start_time = time.perf_counter()
+        self.elapsed = None
+
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, name: str, start_time: float, elapsed: float, **attributes) -> bool:
+        with self.lock:
+            # e.g. a pipeline that lost the race and finished after the answer
+            if self.elapsed is not None:
+                return False
+
+            self.spans.append(
+                {
+                    "name": name,
+                    "start": start_time - self.start_time,
+                    "seconds": elapsed,
+                    **attributes,
+                }
+            )
+            return True
+
+    def finish(self) -> None:
+        with self.lock:
+            self.elapsed = time.perf_counter() - self.start_time
+
+    def stages(self) -> Dict[str, float]:
+        stages = {}
+        for span in self.spans:
+            stages[span["name"]] = stages.get(span["name"], 0.0) + span["seconds"]
+        return stages
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "time": self.wall_time,
+            "seconds": self.elapsed,
+            **self.attributes,
+            "spans": self.spans,
+        }
+
+
+class Metrics:
+    # Latency histograms per request name and per stage, and an optional log
+    # of every trace as a line of JSON. Spans that end after their request,
+    # e.g. of a pipeline that lost the race, are single spans rather than the
+    # per-request sums of `stages`, and go to `late_stages` instead.
+    def __init__(self) -> None:
+        self.requests = {}
+        self.stages = {}
+        self.late_stages = {}
+
+        self.lock = threading.Lock()
+        self.trace_lock = threading.Lock()
+
+        self.configure({})
+
+    def configure(self, config: dict) -> None:
+        self.config = config
+
+        # samples kept for the percentiles of each histogram created after
+        self.window = config.get("metrics_window", 1000)
+        self.trace_log = config.get("trace_log", None)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.requests = {}
+            self.stages = {}
+            self.late_stages = {}
+
+    def observe(self, histograms: dict, name: str, value: float) -> None:
+        with self.lock:
+            if name not in histograms:
+                histograms[name] = Histogram(self.window)
+            histograms[name].observe(value)
+
+    def observe_stage(self, name: str, value: float) -> None:
+        self.observe(self.stages, name, value)
+
+    def observe_late_stage(self, name: str, value: float) -> None:
+        self.observe(self.late_stages, name, value)
+
+    def record(self, trace: Trace) -> None:
+        self.observe(self.requests, trace.name, trace.elapsed)
+        for name, value in trace.stages().items():
+            self.observe_stage(name, value)
+
+        if self.trace_log is not None:
+            self.write(trace)
+
+    def write(self, trace: Trace) -> None:
+        try:
+            line = json.dumps(trace.to_dict())
+            with self.trace_lock, open(self.trace_log, "a") as f:
+                f.write(line + "\n")
+        except (OSError, TypeError, ValueError) as e:
+            logging.warning(f"Failed to write trace `{trace.id}`: {e}")
+
+    def report(self) -> dict:
+        with self.lock:
+            return {
+                "requests": {x: h.report() for x, h in self.requests.items()},
+                "stages": {x: h.report() for x, h in self.stages.items()},
+                "late_stages": {x: h.report() for x, h in self.late_stages.items()},
+            }
+
+
+METRICS = Metrics()
+
+
+class trace:
+    # Makes a trace current for the spans of a request, in this thread and in
+    # the tasks and threads it starts with the context copied. The previous
+    # trace is set back rather than reset, since a streamed answer may be
+    # finished in another context than the one it was started in.
+    def __init__(self, name: str, **attributes) -> None:
+        self.trace = Trace(name, **attributes)
+        self.previous = None
+
+    def __enter__(self) -> Trace:
+        self.previous = current_trace.get()
+        current_trace.set(self.trace)
+        return self.trace
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        current_trace.set(self.previous)
+
+        self.trace.finish()
+        METRICS.record(self.trace)
+
+
+def annotate(**attributes) -> None:
+    # e.g. the pipeline that answered, on the trace of the current request
+    request_trace = current_trace.get()
+    if request_trace is not None:
+        request_trace.attributes.update(attributes)
 
 
 class Timer:
 
-    def __init__(self, name: str = None):
+    def __init__(self, name: str = None, **attributes):
         self.start_time = 0
         self.end_time = 0
+        self.elapsed = 0.0
 
         self.name = name or "Timer"
+        self.attributes = attributes
 
     def __enter__(self):
-        self.start_time = time.time()
+        self.start_time = time.perf_counter()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.end_time = time.time()
-        execution_time = self.end_time - self.start_time
-        print(f"`{self.name}` execution time: {execution_time:.3f} seconds")
+        self.end_time = time.perf_counter()
+        self.elapsed = self.end_time - self.start_time
+
+        logging.debug(f"`{self.name}` execution time: {self.elapsed:.3f} seconds")
+
+        # outside a request, e.g. warm-up, straight into the stage histogram
+        request_trace = current_trace.get()
+        if request_trace is None:
+            METRICS.observe_stage(self.name, self.elapsed)
+        elif not request_trace.add(
+            self.name, self.start_time, self.elapsed, **self.attributes
+        ):
+            METRICS.observe_late_stage(self.name, self.elapsed)
+
 
+def measure_time(func: Callable = None, name: str = None):
+    # `@measure_time`, `@measure_time(name=...)` or `measure_time(func, name)`
+    if func is None:
+        return functools.partial(measure_time, name=name)
 
-def measure_time(func, name: str = None):
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        with Timer(name):
+        with Timer(name or func.__qualname__):
             return func(*args, **kwargs)
 
     return wrapper
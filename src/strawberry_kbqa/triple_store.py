@@ -0,0 +1,199 @@
+import threading
+from array import array
+from typing import Hashable, Iterator, List, Tuple
+
+# unsigned 32-bit term ids and row numbers
+TYPECODE = "I"
+
+
+class TermDictionary:
+    def __init__(self) -> None:
+        self.terms = []
+        self.ids = {}
+
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+    def __getitem__(self, term_id: int) -> Hashable:
+        return self.terms[term_id]
+
+    def __contains__(self, term: Hashable) -> bool:
+        return term in self.ids
+
+    def intern(self, term: Hashable) -> int:
+        term_id = self.ids.get(term)
+        if term_id is not None:
+            return term_id
+
+        with self.lock:
+            term_id = self.ids.get(term)
+            if term_id is None:
+                term_id = len(self.terms)
+                self.terms.append(term)
+                self.ids[term] = term_id
+
+        return term_id
+
+    def lookup(self, term: Hashable) -> int:
+        return self.ids.get(term, -1)
+
+
+class ColumnIndex:
+    # Rows sorted by term id (CSR layout) for the bulk of the column, and a small
+    # dict for the rows appended since the last rebuild. The delta is folded
+    # into the sorted arrays once it grows past a fraction of the column.
+    min_delta_size = 1024
+    max_delta_ratio = 8
+
+    def __init__(self, column: array) -> None:
+        self.column = column
+
+        self.offsets = array(TYPECODE, [0])
+        self.rows = array(TYPECODE)
+
+        self.delta = {}
+        self.delta_size = 0
+
+        self.lock = threading.RLock()
+
+    @property
+    def indexed_size(self) -> int:
+        return len(self.rows) + self.delta_size
+
+    def refresh(self) -> None:
+        if self.indexed_size == len(self.column):
+            return
+
+        with self.lock:
+            pending = len(self.column) - self.indexed_size
+            if not pending:
+                return
+
+            max_delta = max(self.min_delta_size, len(self.rows) // self.max_delta_ratio)
+            if self.delta_size + pending > max_delta:
+                self.rebuild()
+                return
+
+            for row in range(self.indexed_size, len(self.column)):
+                self.delta.setdefault(self.column[row], []).append(row)
+            self.delta_size += pending
+
+    def rebuild(self) -> None:
+        column = self.column[:]
+        size = max(column) + 1 if column else 0
+
+        counts = array(TYPECODE, bytes(size * array(TYPECODE).itemsize))
+        for term_id in column:
+            counts[term_id] += 1
+
+        offsets = array(TYPECODE, [0]) * (size + 1)
+        for term_id in range(size):
+            offsets[term_id + 1] = offsets[term_id] + counts[term_id]
+
+        rows = array(TYPECODE, bytes(len(column) * array(TYPECODE).itemsize))
+        cursor = offsets[:-1]
+        for row, term_id in enumerate(column):
+            rows[cursor[term_id]] = row
+            cursor[term_id] += 1
+
+        self.offsets = offsets
+        self.rows = rows
+        self.delta = {}
+        self.delta_size = 0
+
+    def lookup(self, term_id: int) -> List[int]:
+        with self.lock:
+            self.refresh()
+
+            rows = []
+            if 0 <= term_id < len(self.offsets) - 1:
+                start, end = self.offsets[term_id], self.offsets[term_id + 1]
+                rows = self.rows[start:end].tolist()
+
+            return rows + self.delta.get(term_id, [])
+
+    def unique(self) -> List[int]:
+        with self.lock:
+            self.refresh()
+
+            term_ids = [
+                term_id
+                for term_id in range(len(self.offsets) - 1)
+                if self.offsets[term_id + 1] > self.offsets[term_id]
+            ]
+            indexed = set(term_ids)
+            term_ids += [term_id for term_id in self.delta if term_id not in indexed]
+
+            return term_ids
+
+
+class TripleStore:
+    def __init__(self, terms: TermDictionary = None) -> None:
+        self.terms = terms if terms is not None else TermDictionary()
+
+        self.subjects = array(TYPECODE)
+        self.predicates = array(TYPECODE)
+        self.objects = array(TYPECODE)
+
+        self.subject_index = ColumnIndex(self.subjects)
+        self.predicate_index = ColumnIndex(self.predicates)
+        self.object_index = ColumnIndex(self.objects)
+
+        # predicate ids that spell `rdf:type` in any letter case
+        self.type_ids = set()
+        self.predicate_ids = set()
+
+    def __len__(self) -> int:
+        return len(self.subjects)
+
+    def add(self, subject: Hashable, predicate: Hashable, object: Hashable) -> int:
+        return self.add_ids(
+            self.terms.intern(subject),
+            self.terms.intern(predicate),
+            self.terms.intern(object),
+        )
+
+    def add_ids(self, subject_id: int, predicate_id: int, object_id: int) -> int:
+        if predicate_id not in self.predicate_ids:
+            self.predicate_ids.add(predicate_id)
+            if str(self.terms[predicate_id]).lower() == "rdf:type":
+                self.type_ids.add(predicate_id)
+
+        self.subjects.append(subject_id)
+        self.predicates.append(predicate_id)
+        self.objects.append(object_id)
+
+        return len(self.subjects) - 1
+
+    def get_ids(self, row: int) -> Tuple[int, int, int]:
+        return self.subjects[row], self.predicates[row], self.objects[row]
+
+    def get_triple(self, row: int) -> List[Hashable]:
+        terms = self.terms.terms
+        return [
+            terms[self.subjects[row]],
+            terms[self.predicates[row]],
+            terms[self.objects[row]],
+        ]
+
+    def iter_triples(self) -> Iterator[List[Hashable]]:
+        terms = self.terms.terms
+        for subject_id, predicate_id, object_id in zip(
+            self.subjects, self.predicates, self.objects
+        ):
+            yield [terms[subject_id], terms[predicate_id], terms[object_id]]
+
+    def is_type(self, row: int) -> bool:
+        return self.predicates[row] in self.type_ids
+
+    def type_rows(self) -> List[int]:
+        rows = []
+        for predicate_id in self.type_ids:
+            rows += self.predicate_index.lookup(predicate_id)
+        return sorted(rows)
+
+    def nbytes(self) -> int:
+        columns = (self.subjects, self.predicates, self.objects)
+        return sum(x.itemsize * len(x) for x in columns)
@@ -0,0 +1,334 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Any, FrozenSet, List
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+
+from cache import LRUCache
+from context import ContextData, make_id, tokenize
+from timer import Timer
+
+
+class VectorStoreCache:
+    def __init__(self, config: dict = None) -> None:
+        self.configure(config or {})
+
+        self.memory = LRUCache(self.max_size)
+
+    def configure(self, config: dict) -> None:
+        self.config = config
+
+        self.max_size = config.get("index_cache_size", 16)
+        self.cache_dir = config.get("index_cache_dir", None)
+
+    @staticmethod
+    def make_key(context: str, model_name: str) -> str:
+        return hashlib.sha256(f"{model_name}\n{context}".encode("utf-8")).hexdigest()
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key: str, embeddings: Embeddings) -> FAISS:
+        db = self.memory.get(key)
+        if db is not None:
+            logging.debug(f"Vector store cache hit (memory): `{key}`")
+            return db
+
+        if self.cache_dir is None:
+            return None
+
+        db = self.load(key, embeddings)
+        if db is not None:
+            logging.debug(f"Vector store cache hit (disk): `{key}`")
+            self.memory.put(key, db)
+
+        return db
+
+    def put(self, key: str, db: FAISS) -> None:
+        self.memory.put(key, db)
+
+        if self.cache_dir is not None:
+            self.save(key, db)
+
+    def load(self, key: str, embeddings: Embeddings) -> FAISS:
+        path = self.get_path(key)
+        if not os.path.isdir(path):
+            return None
+
+        try:
+            return FAISS.load_local(
+                path, embeddings, allow_dangerous_deserialization=True
+            )
+        except Exception as e:
+            logging.warning(f"Failed to load vector store from `{path}`: {e}")
+            return None
+
+    def save(self, key: str, db: FAISS) -> None:
+        path = self.get_path(key)
+        if os.path.isdir(path):
+            return
+
+        # write next to the final path and rename, so that other workers never
+        # load a half-written index
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            db.save_local(tmp_path)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            # e.g. another worker saved the same index first
+            logging.warning(f"Failed to save vector store to `{path}`: {e}")
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def clear(self) -> None:
+        self.memory.clear()
+
+    def stats(self) -> dict:
+        return self.memory.stats()
+
+
+class IncrementalVectorStore:
+    # The FAISS store of one context, updated in place as its triples change.
+    # Searches hold the lock too, an update deletes from the store they read.
+    # Contexts that share the store, e.g. the inline ones of `RAGPipeline`, are
+    # searched through a retriever pinned to their lines, see `search`.
+    def __init__(self, embeddings: Embeddings) -> None:
+        self.embeddings = embeddings
+
+        self.db = None
+        self.ids = set()
+
+        # of the lines indexed, see `make_key`
+        self.key = None
+
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @staticmethod
+    def make_key(texts: List[str]) -> str:
+        return make_id("\n".join(texts))
+
+    def update(self, texts: List[str]) -> "IncrementalVectorStore":
+        with self.lock:
+            self.apply(texts, self.make_key(texts))
+        return self
+
+    def apply(self, texts: List[str], key: str) -> None:
+        # With the lock held. FAISS cannot be built from zero documents, an empty
+        # context is indexed as one empty document like `create_documents`.
+        documents = {make_id(text): text for text in texts or [""]}
+
+        added = [x for x in documents if x not in self.ids]
+        removed = [x for x in self.ids if x not in documents]
+
+        with Timer("embedding"):
+            vectors = (
+                self.embeddings.embed_documents([documents[x] for x in added])
+                if added
+                else []
+            )
+        text_embeddings = list(zip([documents[x] for x in added], vectors))
+
+        with Timer("faiss_build"):
+            if self.db is None:
+                self.db = FAISS.from_embeddings(
+                    text_embeddings, self.embeddings, ids=added
+                )
+            else:
+                if removed:
+                    self.db.delete(removed)
+                if added:
+                    self.db.add_embeddings(text_embeddings, ids=added)
+
+        self.ids = set(documents)
+        self.key = key
+
+        logging.debug(
+            f"Incremental index updated: +{len(added)} -{len(removed)} "
+            f"({len(self.ids)} documents)"
+        )
+
+    def search(
+        self, query: str, k: int = 4, texts: List[str] = None, key: str = None
+    ) -> List[Document]:
+        # embedded before taking the lock, updates do not wait on it
+        embedding = self.embeddings.embed_query(query)
+        with self.lock:
+            # another context was indexed since `texts`, back to them first
+            if texts is not None and key != self.key:
+                self.apply(texts, key)
+
+            if self.db is None:
+                return []
+            return self.db.similarity_search_by_vector(embedding, k)
+
+    def as_retriever(self, search_kwargs: dict = None) -> BaseRetriever:
+        # like `FAISS.as_retriever`, `texts` in `search_kwargs` pins the lines
+        search_kwargs = dict(search_kwargs or {})
+        if search_kwargs.get("texts") is not None:
+            search_kwargs["key"] = self.make_key(search_kwargs["texts"])
+        return IncrementalRetriever(store=self, **search_kwargs)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.db = None
+            self.ids = set()
+            self.key = None
+
+
+class IncrementalRetriever(BaseRetriever):
+    store: Any
+    k: int = 4
+    texts: List[str] = None
+    key: str = None
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return self.store.search(query, self.k, self.texts, self.key)
+
+
+class SemanticAnswerCache:
+    # Past answers indexed by the embedding of their question, one small FAISS
+    # index per scope (context fingerprint and pipeline configuration). Vectors
+    # are normalized, so inner product scores are cosine similarities. A hit
+    # also needs the same entities, see `get_entities`.
+    def __init__(self, embeddings: Embeddings, config: dict = None) -> None:
+        self.embeddings = embeddings
+        self.configure(config or {})
+
+        self.indexes = {}
+        self.entries = OrderedDict()
+        self.next_id = 0
+
+        # lowercase words of the subjects and objects per store, built on use
+        self.words = weakref.WeakKeyDictionary()
+
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, config: dict) -> None:
+        self.config = config
+
+        self.threshold = config.get("semantic_cache_threshold", 0.92)
+        self.max_size = config.get("semantic_cache_size", 1024)
+
+        # nearest questions checked for one with the same entities
+        self.candidates = config.get("semantic_cache_candidates", 4)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def embed(self, question: str) -> np.ndarray:
+        # `embed_documents` goes through the embeddings cache, `embed_query` not
+        with Timer("embedding"):
+            vector = self.embeddings.embed_documents([question])
+        vector = np.array(vector, dtype="float32")
+        faiss.normalize_L2(vector)
+        return vector
+
+    def get_entities(self, question: str, context_data: ContextData) -> FrozenSet[str]:
+        # The words of the question that are in the names of the context, e.g.
+        # "timmy". "How old is Timmy?" and "How old is Tommy?" embed alike.
+        store = context_data.store
+        with self.lock:
+            words = self.words.get(store)
+
+        if words is None:
+            words = set()
+            for term_id in store.subject_index.unique() + store.object_index.unique():
+                words.update(tokenize(str(store.terms[term_id])))
+            with self.lock:
+                self.words[store] = words
+
+        return frozenset(x for x in tokenize(question) if x in words)
+
+    def get(
+        self, scope: str, vector: np.ndarray, entities: FrozenSet[str] = frozenset()
+    ) -> str:
+        with self.lock:
+            index = self.indexes.get(scope)
+            if index is None or index.ntotal == 0:
+                self.misses += 1
+                return None
+
+            scores, ids = index.search(vector, min(self.candidates, index.ntotal))
+            for score, entry_id in zip(scores[0], ids[0]):
+                score, entry_id = float(score), int(entry_id)
+                if entry_id == -1 or score < self.threshold:
+                    break
+                if self.entries[entry_id][2] != entities:
+                    continue
+
+                self.hits += 1
+                self.entries.move_to_end(entry_id)
+                logging.debug(f"Semantic cache hit with similarity {score:.3f}")
+
+                return self.entries[entry_id][1]
+
+            self.misses += 1
+            return None
+
+    def put(
+        self,
+        scope: str,
+        vector: np.ndarray,
+        answer: str,
+        entities: FrozenSet[str] = frozenset(),
+    ) -> None:
+        if self.max_size <= 0:
+            return
+
+        with self.lock:
+            index = self.indexes.get(scope)
+            if index is None:
+                index = faiss.IndexIDMap2(faiss.IndexFlatIP(vector.shape[1]))
+                self.indexes[scope] = index
+
+            entry_id = self.next_id
+            self.next_id += 1
+
+            index.add_with_ids(vector, np.array([entry_id], dtype="int64"))
+            self.entries[entry_id] = (scope, answer, entities)
+
+            while len(self.entries) > self.max_size:
+                self.evict()
+
+    def evict(self) -> None:
+        entry_id, (scope, _, _) = self.entries.popitem(last=False)
+
+        index = self.indexes[scope]
+        index.remove_ids(np.array([entry_id], dtype="int64"))
+        if index.ntotal == 0:
+            del self.indexes[scope]
+
+    def clear(self) -> None:
+        with self.lock:
+            self.indexes = {}
+            self.entries = OrderedDict()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
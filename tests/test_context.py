@@ -0,0 +1,95 @@
+import os
+import sys
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "src", "strawberry_kbqa"
+    )
+)
+
+from context import ContextData
+
+TRIPLES = {
+    "triples": [
+        {"subject": "person1", "predicate": "hasName", "object": "Timmy"},
+        {"subject": "person1", "predicate": "hasAge", "object": "25"},
+        {"subject": "person1", "predicate": "hasFriend", "object": "person2"},
+        {"subject": "person1", "predicate": "hasPet", "object": "cat"},
+        {"subject": "person2", "predicate": "hasName", "object": "Tommy"},
+        {"subject": "person2", "predicate": "hasFriend", "object": "person1"},
+        {"subject": "haru", "predicate": "hasName", "object": "Haru"},
+        {"subject": "haru", "predicate": "hasHomeCountry", "object": "Japan"},
+        {"subject": "Japan", "predicate": "rdf:type", "object": "Country"},
+        {"subject": "haru", "predicate": "hasFavorite", "object": "Fall"},
+        {"subject": "Fall", "predicate": "rdf:type", "object": "Season"},
+        {"subject": "haru", "predicate": "hasFavorite", "object": "Godzilla"},
+        {"subject": "Godzilla", "predicate": "RDF:type", "object": "Movie"},
+        {"subject": "haru", "predicate": "hasFavorite", "object": "Watching_TV"},
+        {"subject": "Watching_TV", "predicate": "rdf:type", "object": "Hobby"},
+    ]
+}
+
+# the compact form of `TRIPLES` from the list based `ContextData` before the
+# triple store
+COMPACT = [
+    ["Timmy", "hasName", "Timmy"],
+    ["Timmy", "hasAge", "25"],
+    ["Timmy", "hasFriend", "Tommy"],
+    ["Timmy", "hasPet", "cat"],
+    ["Tommy", "hasName", "Tommy"],
+    ["Tommy", "hasFriend", "Timmy"],
+    ["Haru", "hasName", "Haru"],
+    ["Haru", "hasHomeCountryCountry", "Japan"],
+    ["Haru", "hasFavoriteSeason", "Fall"],
+    ["Haru", "hasFavoriteMovie", "Godzilla"],
+    ["Haru", "hasFavoriteHobby", "Watching_TV"],
+]
+
+
+def test_compact_form():
+    compact = ContextData.from_triples(TRIPLES).to_compact_form()
+
+    assert compact.to_list_simple() == COMPACT
+    assert str(compact) == "\n".join(str(x) for x in COMPACT)
+
+
+def test_extra_fields_ignored():
+    triples = {
+        "triples": [
+            {"subject": "person1", "predicate": "hasName", "object": "Timmy"},
+            {
+                "subject": "person1",
+                "predicate": "hasAge",
+                "object": "25",
+                "source": "profile",
+            },
+        ]
+    }
+
+    context_data = ContextData.from_triples(triples)
+    assert context_data.to_list_simple() == [
+        ["person1", "hasName", "Timmy"],
+        ["person1", "hasAge", "25"],
+    ]
+    assert context_data.to_list_compact()[1] == ["Timmy", "hasAge", "25"]
+
+
+def test_lookups_after_adding():
+    context_data = ContextData.from_triples(TRIPLES)
+    assert [x.triple for x in context_data.get_all_with_subject("person2")] == [
+        ["person2", "hasName", "Tommy"],
+        ["person2", "hasFriend", "person1"],
+    ]
+
+    context_data.add_triples(
+        {"triples": [{"subject": "person2", "predicate": "hasAge", "object": "26"}]}
+    )
+    assert len(context_data.get_all_with_subject("person2")) == 3
+    assert [
+        x.triple
+        for x in context_data.get_all_with_subject_predicate("person2", "hasAge")
+    ] == [["person2", "hasAge", "26"]]
+    assert [x.triple[0] for x in context_data.get_all_with_object("person1")] == [
+        "person2"
+    ]
+    assert context_data.get_all_with_subject("nobody") == []
@@ -0,0 +1,100 @@
+import json
+import os
+import sys
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "src", "strawberry_kbqa"
+    )
+)
+
+from evaluate import Checkpoint, Evaluator
+from timer import annotate
+
+
+def test_checkpoint_out_of_order(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint"))
+
+    for line in [2, 0, 4]:
+        checkpoint.add(line)
+    assert checkpoint.done_below == 1
+    assert checkpoint.done == {2, 4}
+    assert 0 in checkpoint and 2 in checkpoint and 1 not in checkpoint
+
+    checkpoint.add(1)
+    assert checkpoint.done_below == 3
+    assert checkpoint.done == {4}
+
+
+def test_checkpoint_resume(tmp_path):
+    path = str(tmp_path / "checkpoint")
+
+    checkpoint = Checkpoint(path)
+    for line in [0, 1, 3]:
+        checkpoint.add(line)
+    checkpoint.save(42)
+
+    resumed = Checkpoint(path)
+    assert resumed.done_below == 2
+    assert resumed.done == {3}
+    assert resumed.output_offset == 42
+    assert [x for x in range(5) if x not in resumed] == [2, 4]
+
+
+def test_output_truncated_to_checkpoint(tmp_path):
+    output_path = tmp_path / "answers.jsonl"
+    saved = json.dumps({"line": 0, "answer": "a"}) + "\n"
+    output_path.write_text(saved + '{"line": 1, "ans')
+
+    evaluator = Evaluator.__new__(Evaluator)
+    evaluator.output_path = str(output_path)
+    evaluator.checkpoint = Checkpoint(str(tmp_path / "checkpoint"))
+    evaluator.checkpoint.output_offset = len(saved)
+
+    with evaluator.open_output() as output:
+        output.write(b'{"line": 1}\n')
+
+    assert output_path.read_text() == saved + '{"line": 1}\n'
+
+
+class FailingHandler:
+    # every pipeline fails `failures` times, then `Pipeline` answers
+    def __init__(self, failures: int) -> None:
+        self.failures = failures
+        self.calls = 0
+
+    def get_context(self, triples, context_id=None):
+        return None
+
+    def answer_context(self, question, compact_context, context_id=None):
+        self.calls += 1
+        if self.calls <= self.failures:
+            return ""
+        annotate(winner="Pipeline")
+        return "An answer."
+
+
+def create_evaluator(qa_handler, retries: int) -> Evaluator:
+    evaluator = Evaluator.__new__(Evaluator)
+    evaluator.qa_handler = qa_handler
+    evaluator.default_context = None
+    evaluator.retries = retries
+    evaluator.retry_wait = 0.0
+    return evaluator
+
+
+def test_unanswered_retried():
+    evaluator = create_evaluator(FailingHandler(failures=1), retries=1)
+
+    result = evaluator.evaluate(0, json.dumps({"question": "How old is Timmy?"}))
+    assert result["answer"] == "An answer."
+    assert result["winner"] == "Pipeline"
+    assert evaluator.qa_handler.calls == 2
+
+
+def test_unanswered_written_as_error():
+    evaluator = create_evaluator(FailingHandler(failures=3), retries=2)
+
+    result = evaluator.evaluate(0, json.dumps({"question": "How old is Timmy?"}))
+    assert "error" in result and "answer" not in result
+    assert evaluator.qa_handler.calls == 3
@@ -0,0 +1,66 @@
+import os
+import random
+import sys
+import time
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "src", "strawberry_kbqa"
+    )
+)
+
+from context import UnknownContextError
+from qa import QAHandler
+
+
+class StubHandler(QAHandler):
+    # the batching of `iter_answer_many` over answers made up from the items
+    def __init__(self) -> None:
+        self.batch_max_parallel = 4
+        self.contexts = []
+
+    def get_context(self, triple_data: dict = None, context_id: str = None):
+        if context_id is not None:
+            raise UnknownContextError(context_id)
+        if "triples" not in triple_data:
+            raise ValueError("no triples")
+        self.contexts.append(triple_data["name"])
+        return triple_data["name"]
+
+    def answer_context(self, question, compact_context, context_id=None):
+        time.sleep(random.random() / 100)
+        if question == "fail":
+            raise RuntimeError("pipeline down")
+        return f"{compact_context}: {question}"
+
+
+def test_answers_in_order_with_errors():
+    a = {"name": "a", "triples": []}
+    b = {"name": "b", "triples": []}
+    items = [
+        {"question": "q0", "context": a},
+        {"question": "q1", "context": b},
+        {"question": "fail", "context": a},
+        {"question": "q3", "context_id": "missing"},
+        {"question": "q4", "context": {"name": "c"}},
+    ]
+    items += [{"question": f"q{x}", "context": [a, b][x % 2]} for x in range(5, 20)]
+
+    handler = StubHandler()
+    answers = handler.answer_many(items)
+
+    assert [x.index for x in answers] == list(range(len(items)))
+    assert answers[0].answer == "a: q0" and answers[1].answer == "b: q1"
+    assert answers[2].answer is None and answers[2].error == "pipeline down"
+    assert answers[3].error == "unknown context_id: missing"
+    assert answers[4].error.startswith("invalid context")
+    for index in range(5, 20):
+        assert answers[index].answer == f"{'ab'[index % 2]}: q{index}"
+        assert answers[index].error is None
+
+    # compacted once per context
+    assert sorted(handler.contexts) == ["a", "b"]
+
+
+def test_no_items():
+    assert StubHandler().answer_many([]) == []
@@ -0,0 +1,76 @@
+import os
+import sys
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "src", "strawberry_kbqa"
+    )
+)
+
+from retriever import BM25Index, HybridRetriever
+
+LINES = [
+    "['Timmy', 'hasAge', '25']",
+    "['Timmy', 'hasPet', 'cat']",
+    "['Tommy', 'hasAge', '26']",
+    "['Haru', 'hasFavoriteFood', 'sushi']",
+]
+
+
+def state(index: BM25Index) -> tuple:
+    postings = {token: dict(x) for token, x in index.postings.items()}
+    return index.documents, index.lengths, postings, index.total_length
+
+
+def test_tokenize_camel_case():
+    assert BM25Index.tokenize("hasFavoriteFood Timmy") == [
+        "has",
+        "favorite",
+        "food",
+        "hasfavoritefood",
+        "timmy",
+    ]
+
+
+def test_update_adds_and_removes():
+    index = BM25Index().update(LINES)
+    assert len(index) == 4
+
+    changed = LINES[:2] + ["['Tommy', 'hasAge', '27']", "['Haru', 'hasAge', '7']"]
+    index.update(changed)
+
+    # the same as an index built from the changed lines
+    assert state(index) == state(BM25Index().update(changed))
+    assert "26" not in index.postings and "sushi" not in index.postings
+
+    assert index.search("How old is Tommy?", k=1)[0][0] == changed[2]
+    assert index.search("sushi") == []
+
+    index.update([])
+    assert len(index) == 0 and index.total_length == 0 and not index.postings
+    assert index.search("Timmy") == []
+
+
+def test_search_ranks_matching_lines():
+    index = BM25Index().update(LINES)
+
+    texts = [text for text, _ in index.search("Timmy's pet", k=2)]
+    assert texts == [LINES[1], LINES[0]]
+
+
+def test_search_pinned_to_lines():
+    # another context was indexed since, the search goes back to its lines
+    index = BM25Index().update(LINES)
+    key = BM25Index.make_key(LINES)
+    index.update(["['Zed', 'hasAge', '3']"])
+
+    assert index.search("Timmy", k=4, texts=LINES, key=key)[0][0] in LINES[:2]
+    assert len(index) == 4 and index.key == key
+
+
+def test_hybrid_lexical_only():
+    retriever = HybridRetriever(lexical=BM25Index().update(LINES), k=2)
+
+    documents = retriever.invoke("Haru favorite food")
+    assert documents[0].page_content == LINES[3]
+    assert len(documents) <= 2
@@ -0,0 +1,69 @@
+import os
+import sys
+
+import pytest
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "src", "strawberry_kbqa"
+    )
+)
+
+from context import ContextData
+from nlp import NLP, Analysis
+from structured import StructuredPipeline
+
+TRIPLES = {
+    "triples": [
+        {"subject": "person1", "predicate": "hasName", "object": "Timmy"},
+        {"subject": "person1", "predicate": "hasAge", "object": "25"},
+        {"subject": "person1", "predicate": "hasProfession", "object": "Mechanic"},
+        {"subject": "person1", "predicate": "hasHometown", "object": "California"},
+        {"subject": "person1", "predicate": "hasPet", "object": "cat"},
+        {"subject": "person1", "predicate": "hasFriend", "object": "person2"},
+        {"subject": "person2", "predicate": "hasName", "object": "Tommy"},
+    ]
+}
+
+
+@pytest.fixture
+def context_data(monkeypatch):
+    # names are found in the words of the question, without a spaCy model
+    monkeypatch.setattr(
+        NLP,
+        "analyse",
+        lambda texts, **kwargs: [Analysis(x, [], [], [], []) for x in texts],
+    )
+    return ContextData.from_triples(TRIPLES).to_compact_form()
+
+
+@pytest.mark.parametrize(
+    "question, answer",
+    [
+        ("How old is Timmy?", "Timmy is 25 years old."),
+        ("What is Timmy's age?", "Timmy is 25 years old."),
+        ("Where is Timmy from?", "Timmy is from California."),
+        ("What does Timmy do for work?", "Timmy is a Mechanic."),
+        ("Who is Timmy's friend?", "Timmy's friend is Tommy."),
+    ],
+)
+def test_direct_questions(context_data, question, answer):
+    assert StructuredPipeline().lookup(question, context_data) == answer
+
+
+@pytest.mark.parametrize(
+    "question",
+    [
+        "How old was Timmy two years ago?",
+        "How old will Timmy be in 5 years?",
+        "What is Timmy's age in months?",
+        "What is the name of Timmy's cat?",
+        "Which pet does Timmy not have?",
+        "Which pet doesn't Timmy have?",
+        "How many pets does Timmy have?",
+        "Is Timmy old?",
+        "What is the capital of France?",
+    ],
+)
+def test_falls_through(context_data, question):
+    assert StructuredPipeline().lookup(question, context_data) == ""
@@ -0,0 +1,72 @@
+import os
+import random
+import sys
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "src", "strawberry_kbqa"
+    )
+)
+
+from triple_store import ColumnIndex, TripleStore
+
+
+def expected_rows(column, term_id):
+    return [row for row, x in enumerate(column) if x == term_id]
+
+
+def test_lookups_across_delta_rebuilds(monkeypatch):
+    # a small delta, so that appends alternate between the delta and rebuilds
+    monkeypatch.setattr(ColumnIndex, "min_delta_size", 4)
+    monkeypatch.setattr(ColumnIndex, "max_delta_ratio", 2)
+
+    rng = random.Random(0)
+    store = TripleStore()
+    rebuilds = 0
+    for step in range(200):
+        subject = f"s{rng.randrange(20)}"
+        store.add(subject, f"p{rng.randrange(5)}", f"o{rng.randrange(30)}")
+
+        index = store.subject_index
+        indexed = len(index.rows)
+        term_id = store.terms.lookup(subject)
+        assert index.lookup(term_id) == expected_rows(store.subjects, term_id)
+        rebuilds += len(index.rows) != indexed
+
+        for column, index in [
+            (store.subjects, store.subject_index),
+            (store.predicates, store.predicate_index),
+            (store.objects, store.object_index),
+        ]:
+            assert sorted(index.unique()) == sorted(set(column))
+            assert index.indexed_size == len(column)
+
+    assert rebuilds > 1
+    assert store.subject_index.delta_size < len(store)
+
+    for term_id in range(len(store.terms)):
+        for column, index in [
+            (store.subjects, store.subject_index),
+            (store.objects, store.object_index),
+        ]:
+            assert sorted(index.lookup(term_id)) == expected_rows(column, term_id)
+
+
+def test_unknown_terms():
+    store = TripleStore()
+    store.add("Timmy", "hasAge", "25")
+
+    assert store.terms.lookup("Tommy") == -1
+    assert store.subject_index.lookup(-1) == []
+    assert store.subject_index.lookup(store.terms.lookup("25")) == []
+
+
+def test_type_rows_any_case():
+    store = TripleStore()
+    store.add("Japan", "rdf:type", "Country")
+    store.add("haru", "hasHomeCountry", "Japan")
+    store.add("Fall", "RDF:type", "Season")
+
+    assert store.type_rows() == [0, 2]
+    assert store.get_triple(2) == ["Fall", "RDF:type", "Season"]
+    assert list(store.iter_triples())[1] == ["haru", "hasHomeCountry", "Japan"]